@@ -195,4 +195,43 @@ CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels.layers.InMemoryChannelLayer',
     },
-}
\ No newline at end of file
+}
+
+# Cache of the rendered room payloads, local to the process by default.
+# When several processes serve HTTP use a shared backend, e.g.
+# CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache CACHE_LOCATION=/var/tmp/ai_powered_house
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'ai_powered_house'),
+    },
+}
+
+# Face recognition
+# number of worker processes running detection and encoding, unset for one per core
+# but the one left to the event loop (see executor.default_workers)
+FACE_RECOGNITION_WORKERS = int(os.getenv('FACE_RECOGNITION_WORKERS')) if os.getenv('FACE_RECOGNITION_WORKERS') else None
+# recall target of the approximate (IVF) gallery index, e.g. 0.95, galleries are searched exactly when unset
+FACE_RECOGNITION_ANN_RECALL = float(os.getenv('FACE_RECOGNITION_ANN_RECALL')) if os.getenv('FACE_RECOGNITION_ANN_RECALL') else None
+# galleries smaller than this are searched exactly even with a recall target
+FACE_RECOGNITION_ANN_MIN_SIZE = int(os.getenv('FACE_RECOGNITION_ANN_MIN_SIZE', 10000))
+# fraction of the frame thumbnail that must change for a frame to go through face detection
+FACE_RECOGNITION_MOTION_THRESHOLD = float(os.getenv('FACE_RECOGNITION_MOTION_THRESHOLD', 0.01))
+# a frame goes through detection at least every N frames even without motion
+FACE_RECOGNITION_KEYFRAME_INTERVAL = int(os.getenv('FACE_RECOGNITION_KEYFRAME_INTERVAL', 10))
+# a person seen again doing the same action within this many seconds is not recorded again,
+# for the cameras without their own Camera.cooldown
+FACE_RECOGNITION_COOLDOWN_SECONDS = int(os.getenv('FACE_RECOGNITION_COOLDOWN_SECONDS', 60))
+# activities are buffered and written in batches of this size, or every this many seconds
+FACE_RECOGNITION_WRITE_BATCH_SIZE = int(os.getenv('FACE_RECOGNITION_WRITE_BATCH_SIZE', 50))
+FACE_RECOGNITION_WRITE_INTERVAL = float(os.getenv('FACE_RECOGNITION_WRITE_INTERVAL', 2.0))
+# pending activity writes are journaled here until they reach the database
+FACE_RECOGNITION_WRITE_JOURNAL = BASE_DIR / 'activity_journal.jsonl'
+# a frame that would wait for a worker long enough to be recognized later than this many seconds is dropped
+FACE_RECOGNITION_FRAME_DEADLINE = float(os.getenv('FACE_RECOGNITION_FRAME_DEADLINE', 1.5))
+# frames a capture client may have sent and not had answered yet
+FACE_RECOGNITION_CAPTURE_CREDITS = int(os.getenv('FACE_RECOGNITION_CAPTURE_CREDITS', 1))
+# JPEG quality capture clients encode frames at, and the face height in detection pixels
+# under which they are asked for a higher resolution
+FACE_RECOGNITION_CAPTURE_QUALITY = float(os.getenv('FACE_RECOGNITION_CAPTURE_QUALITY', 0.8))
+FACE_RECOGNITION_MIN_FACE_SIZE = int(os.getenv('FACE_RECOGNITION_MIN_FACE_SIZE', 60))
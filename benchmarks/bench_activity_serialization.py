@@ -0,0 +1,75 @@
+"""
+Time to serialize activity listings: ActivitySerializer on model instances
+vs serialize_activity_values on .values() rows, query included, and a check
+that both render to the same JSON bytes.
+
+Runs against a throwaway test database, from the project root:
+    python -m benchmarks.bench_activity_serialization
+"""
+import os
+import time
+from datetime import datetime, time as day_time, timedelta, timezone as dt_timezone
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ai_powered_house.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+django.setup()
+
+from django.db import connection
+from rest_framework.renderers import JSONRenderer
+
+from facerecognition.models import Activity, Person, Room
+from facerecognition.serializers import ActivitySerializer, activity_values, serialize_activity_values
+
+ROWS = (10_000, 100_000)
+
+
+def populate(rows, people):
+    start = datetime(2025, 1, 1, 7, 0, tzinfo=dt_timezone.utc)
+    activities = []
+    for i in range(rows):
+        when = start + timedelta(seconds=37 * i)
+        entering = i % 2 == 0
+        activities.append(Activity(
+            person=people[i % len(people)],
+            room_id=people[i % len(people)].room_id,
+            date=when.date(),
+            enter_date=day_time(8, 0),
+            exit_date=day_time(17, 30),
+            action='enter' if entering else 'exit',
+            actual_enter_date=when if entering else None,
+            actual_exit_date=None if entering else when,
+            image='activities/frame.jpg' if i % 10 == 0 else None,
+        ))
+    Activity.objects.bulk_create(activities, batch_size=5000)
+
+
+def measure(fn):
+    start = time.perf_counter()
+    data = fn()
+    return data, time.perf_counter() - start
+
+
+def main():
+    test_db = connection.creation.create_test_db(verbosity=0)
+    try:
+        rooms = [Room.objects.create(name=f'Room {i}') for i in range(4)]
+        people = [Person.objects.create(name=f'Person {i}', about='Resident', room=rooms[i % 4]) for i in range(20)]
+
+        print(f"{'rows':>7} {'serializer s':>13} {'values s':>9} {'speedup':>8} {'identical':>10}")
+        populated = 0
+        for rows in ROWS:
+            populate(rows - populated, people)
+            populated = rows
+            activities = Activity.objects.order_by('-date', '-id')
+            legacy, legacy_s = measure(lambda: ActivitySerializer(activities.select_related('person'), many=True).data)
+            fast, fast_s = measure(lambda: serialize_activity_values(activity_values(activities)))
+            identical = JSONRenderer().render(legacy) == JSONRenderer().render(fast)
+            print(f"{rows:>7} {legacy_s:>13.2f} {fast_s:>9.2f} {legacy_s / fast_s:>7.1f}x {str(identical):>10}")
+    finally:
+        connection.creation.destroy_test_db(test_db, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
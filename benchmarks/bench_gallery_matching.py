@@ -0,0 +1,77 @@
+"""
+Micro-benchmark: per-face compare_faces + face_distance loop vs the batched
+float32 gallery matching of SimpleFacerec.match_faces.
+
+Run from the project root:
+    python -m benchmarks.bench_gallery_matching
+"""
+import time
+
+import face_recognition
+import numpy as np
+
+from facerecognition.ai_models.simple_facerec import SimpleFacerec, ENCODING_SIZE
+
+GALLERY_SIZES = (10, 1_000, 50_000)
+FACES_PER_FRAME = 5
+REPEAT = 20
+
+
+def legacy_match(known_face_encodings, known_face_names, face_encodings):
+    # The loop SimpleFacerec.detect_known_faces used before batching
+    face_names = []
+    for face_encoding in face_encodings:
+        matches = face_recognition.compare_faces(known_face_encodings, face_encoding)
+        name = "Unknown"
+        face_distances = face_recognition.face_distance(known_face_encodings, face_encoding)
+        best_match_index = np.argmin(face_distances)
+        if matches[best_match_index]:
+            name = known_face_names[best_match_index]
+        face_names.append(name)
+    return face_names
+
+
+def batched_match(sfr, face_encodings):
+    gallery = sfr.snapshot()
+    best_index, best_distance, margin = sfr.match_faces(face_encodings, gallery)
+    return [
+        gallery.names[index] if distance <= sfr.tolerance else "Unknown"
+        for index, distance in zip(best_index, best_distance)
+    ]
+
+
+def timeit(fn, *args):
+    fn(*args)  # warm up
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        fn(*args)
+    return (time.perf_counter() - start) / REPEAT
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'gallery':>8} {'legacy ms':>10} {'batched ms':>11} {'speedup':>8}")
+    for size in GALLERY_SIZES:
+        gallery = rng.normal(scale=0.1, size=(size, ENCODING_SIZE))
+        names = [str(i) for i in range(size)]
+        # Half of the faces are noisy copies of enrolled people, half are strangers
+        faces = np.vstack([
+            gallery[rng.integers(size, size=FACES_PER_FRAME - FACES_PER_FRAME // 2)]
+            + rng.normal(scale=0.01, size=(FACES_PER_FRAME - FACES_PER_FRAME // 2, ENCODING_SIZE)),
+            rng.normal(scale=0.1, size=(FACES_PER_FRAME // 2, ENCODING_SIZE)),
+        ])
+
+        # The legacy path works on a Python list of float64 arrays
+        legacy_gallery = list(gallery)
+        sfr = SimpleFacerec()
+        sfr.set_known_faces(gallery, names)
+
+        assert legacy_match(legacy_gallery, names, list(faces)) == batched_match(sfr, faces)
+
+        legacy = timeit(legacy_match, legacy_gallery, names, list(faces))
+        batched = timeit(batched_match, sfr, faces)
+        print(f"{size:>8} {legacy * 1e3:>10.3f} {batched * 1e3:>11.3f} {legacy / batched:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
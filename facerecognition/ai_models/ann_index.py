@@ -0,0 +1,128 @@
+import numpy as np
+
+
+def sq_distances(queries, vectors, vector_sq_norms):
+    """
+    Squared euclidean distances between every query and every vector, shape (Q, V)
+    """
+    sq_dist = queries @ vectors.T
+    sq_dist *= -2
+    sq_dist += vector_sq_norms
+    sq_dist += np.einsum('ij,ij->i', queries, queries)[:, None]
+    np.maximum(sq_dist, 0, out=sq_dist)
+    return sq_dist
+
+
+def kmeans(vectors, n_clusters, n_iter=10, seed=0):
+    """
+    Plain Lloyd k-means on float32 vectors
+    :return: centroids of shape (n_clusters, D)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = np.argmin(sq_distances(vectors, centroids, np.einsum('ij,ij->i', centroids, centroids)), axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=n_clusters)
+        # Empty clusters keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index: the gallery is partitioned with k-means and a query is
+    only compared with the encodings of the n_probe partitions closest to it.
+
+    The index is immutable like the Gallery it belongs to, with_encodings()
+    reuses the trained centroids and n_probe for an updated gallery.
+    """
+
+    def __init__(self, centroids, n_probe, encodings, trained_size=None):
+        self.centroids = centroids
+        self.centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.n_probe = min(n_probe, len(centroids))
+        # Gallery size the centroids were trained on
+        self.trained_size = len(encodings) if trained_size is None else trained_size
+
+        labels = self._nearest_lists(encodings, 1)[:, 0] if len(encodings) else np.empty(0, dtype=np.intp)
+        # Rows of each list stored contiguously: rows[offsets[k]:offsets[k + 1]]
+        self.rows = np.argsort(labels, kind='stable')
+        self.offsets = np.searchsorted(labels[self.rows], np.arange(len(centroids) + 1))
+
+    @classmethod
+    def train(cls, encodings, recall=0.95, n_lists=None, seed=0):
+        """
+        Build an index over encodings and pick the smallest n_probe reaching the recall target
+        :param recall: expected fraction of queries whose best match is the exact best match
+        :param n_lists: number of partitions, sqrt(N) by default
+        """
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(encodings)))
+        n_lists = max(1, min(n_lists, len(encodings)))
+        # k-means on a sample is enough to place the centroids
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(encodings), 64 * n_lists)
+        sample = encodings[rng.choice(len(encodings), sample_size, replace=False)]
+        centroids = kmeans(np.ascontiguousarray(sample, dtype=np.float32), n_lists, seed=seed)
+
+        index = cls(centroids, n_lists, encodings)
+        index.n_probe = index.calibrate(encodings, recall, seed=seed)
+        return index
+
+    def with_encodings(self, encodings):
+        return IVFIndex(self.centroids, self.n_probe, encodings, self.trained_size)
+
+    def calibrate(self, encodings, recall, n_queries=200, noise=0.03, seed=0):
+        """
+        Smallest n_probe whose recall@1 against exact search reaches the target.
+        Queries are gallery encodings with added noise, like a new photo of an enrolled person.
+        """
+        rng = np.random.default_rng(seed)
+        queries = encodings[rng.choice(len(encodings), min(n_queries, len(encodings)), replace=False)]
+        queries = (queries + rng.normal(scale=noise, size=queries.shape)).astype(np.float32)
+        sq_norms = np.einsum('ij,ij->i', encodings, encodings)
+        exact = np.argmin(sq_distances(queries, encodings, sq_norms), axis=1)
+
+        n_probe = 1
+        while n_probe < len(self.centroids):
+            best, _, _ = self.search(queries, encodings, sq_norms, n_probe)
+            if np.mean(best == exact) >= recall:
+                break
+            n_probe *= 2
+        return min(n_probe, len(self.centroids))
+
+    def _nearest_lists(self, queries, n_probe):
+        sq_dist = sq_distances(queries, self.centroids, self.centroid_sq_norms)
+        if n_probe >= len(self.centroids):
+            return np.tile(np.arange(len(self.centroids)), (len(queries), 1))
+        return np.argpartition(sq_dist, n_probe - 1, axis=1)[:, :n_probe]
+
+    def search(self, queries, encodings, sq_norms, n_probe=None):
+        """
+        Two nearest gallery rows of each query among the probed partitions
+        :return: (best_row, best_sq_distance, second_sq_distance) arrays of length Q,
+                 best_row is -1 and distances are inf when nothing was found
+        """
+        n_probe = self.n_probe if n_probe is None else n_probe
+        n_queries = len(queries)
+        best_row = np.full(n_queries, -1, dtype=np.intp)
+        best_sq = np.full(n_queries, np.inf, dtype=np.float32)
+        second_sq = np.full(n_queries, np.inf, dtype=np.float32)
+
+        for i, lists in enumerate(self._nearest_lists(queries, n_probe)):
+            candidates = np.concatenate([self.rows[self.offsets[k]:self.offsets[k + 1]] for k in lists])
+            if len(candidates) == 0:
+                continue
+            sq_dist = sq_distances(queries[i:i + 1], encodings[candidates], sq_norms[candidates])[0]
+            if len(candidates) == 1:
+                best_row[i], best_sq[i] = candidates[0], sq_dist[0]
+                continue
+            top2 = np.argpartition(sq_dist, 1)[:2]
+            if sq_dist[top2[1]] < sq_dist[top2[0]]:
+                top2 = top2[::-1]
+            best_row[i] = candidates[top2[0]]
+            best_sq[i], second_sq[i] = sq_dist[top2[0]], sq_dist[top2[1]]
+        return best_row, best_sq, second_sq
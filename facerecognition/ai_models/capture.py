@@ -0,0 +1,60 @@
+class CaptureSize:
+    """
+    Resolution and JPEG quality a camera client captures at.
+
+    Detection only looks at the frame scaled by frame_resizing, so the client
+    captures at that scale of its own resolution and the server decodes the
+    frame as it is instead of shrinking a full size one. While the smallest
+    face seen is below min_face pixels high, close to what the detector still
+    finds, the scale doubles up to the full resolution. It halves back down to
+    frame_resizing once the faces are comfortably large for `patience` frames.
+    """
+
+    def __init__(self, frame_resizing, min_face=60, quality=0.8, patience=10):
+        self.frame_resizing = frame_resizing
+        self.scale = frame_resizing
+        self.min_face = min_face
+        self.quality = quality
+        self.patience = patience
+        # (width, height) the client captures at full resolution, None until it tells
+        self.native = None
+        # Consecutive processed frames with only large faces
+        self.large_frames = 0
+
+    def set_native(self, width, height):
+        if (width, height) != self.native:
+            self.native = (width, height)
+            self.scale = self.frame_resizing
+            self.large_frames = 0
+
+    @property
+    def width(self):
+        return max(1, round(self.native[0] * self.scale))
+
+    def as_dict(self):
+        width, height = self.native
+        return {'width': self.width, 'height': max(1, round(height * self.scale)), 'quality': self.quality}
+
+    def observe(self, face_heights):
+        """
+        Adapt the scale to the faces of a processed frame
+        :param face_heights: heights of the faces in pixels of the detection frame
+        :return: True when the scale changed and the client must be told
+        """
+        if self.native is None or not face_heights:
+            return False
+        smallest = min(face_heights)
+        if smallest < self.min_face and self.scale < 1:
+            self.scale = min(1.0, self.scale * 2)
+            self.large_frames = 0
+            return True
+        # Three times the minimum: halving the scale leaves the faces well above it
+        if smallest >= 3 * self.min_face and self.scale > self.frame_resizing:
+            self.large_frames += 1
+            if self.large_frames >= self.patience:
+                self.scale = max(self.frame_resizing, self.scale / 2)
+                self.large_frames = 0
+                return True
+        else:
+            self.large_frames = 0
+        return False
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+ENCODINGS_FILE = 'encodings.npy'
+INDEX_FILE = 'index.json'
+
+
+def content_hash(data):
+    """
+    Key of an image in the store: the sha1 of its raw file bytes
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+class EncodingStore:
+    """
+    On-disk cache of face encodings keyed by image content hash.
+
+    encodings.npy holds a float32 (N, 128) matrix that is memory-mapped on load,
+    index.json maps each content hash to its row, or to null when no face was
+    found in the image so it is not re-encoded on every start either.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._encodings = None
+        self._rows = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(os.path.join(self.path, INDEX_FILE)) as f:
+                rows = json.load(f)
+            encodings = np.load(os.path.join(self.path, ENCODINGS_FILE), mmap_mode='r')
+        except (FileNotFoundError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"encoding store at {self.path} is unreadable, rebuilding it: {e}")
+            self._encodings, self._rows = None, {}
+            return
+        if any(row is not None and row >= len(encodings) for row in rows.values()):
+            print(f"encoding store at {self.path} is inconsistent, rebuilding it")
+            self._encodings, self._rows = None, {}
+            return
+        self._encodings, self._rows = encodings, rows
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    def keys(self):
+        return self._rows.keys()
+
+    def __getitem__(self, key):
+        """
+        :return: a float32 copy of the stored encoding, or None if the image has no face
+        """
+        row = self._rows[key]
+        if row is None:
+            return None
+        return np.array(self._encodings[row], dtype=np.float32)
+
+    def save(self, entries):
+        """
+        Replace the store content with the given entries
+        :param entries: dict of content hash -> encoding (or None when no face was found)
+        """
+        os.makedirs(self.path, exist_ok=True)
+        rows = {}
+        encodings = []
+        for key, encoding in entries.items():
+            if encoding is None:
+                rows[key] = None
+            else:
+                rows[key] = len(encodings)
+                encodings.append(encoding)
+        matrix = np.asarray(encodings, dtype=np.float32).reshape(-1, 128)
+
+        # Release the memory map before replacing the file it points to
+        self._encodings = None
+
+        # Write to temporary files first so a crash never leaves a half written store
+        encodings_path = os.path.join(self.path, ENCODINGS_FILE)
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(encodings_path + '.tmp', 'wb') as f:
+            np.save(f, matrix)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(rows, f)
+        os.replace(encodings_path + '.tmp', encodings_path)
+        os.replace(index_path + '.tmp', index_path)
+        self.load()
@@ -0,0 +1,158 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import weakref
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from .simple_facerec import SimpleFacerec
+
+# Per worker process state: its own warm recognizer, holding a copy of a published gallery
+_worker_sfr = None
+
+
+def _init_worker(settings):
+    global _worker_sfr
+    _worker_sfr = SimpleFacerec()
+    for name, value in settings.items():
+        setattr(_worker_sfr, name, value)
+
+
+def _load_gallery(gallery_dir, generation):
+    encodings = np.load(os.path.join(gallery_dir, f'{generation}.encodings.npy'))
+    names = np.load(os.path.join(gallery_dir, f'{generation}.names.npy'))
+    # The copy keeps the parent's generation, trackers see the same one whichever worker gets the frame
+    _worker_sfr.set_known_faces(encodings, names.tolist(), generation)
+
+
+def _detect(frame, gallery_dir, generation, tracker, roi=None, scale=None):
+    if generation != _worker_sfr.generation:
+        _load_gallery(gallery_dir, generation)
+    # Encoded frames are decoded in the worker, straight at the detection scale
+    if isinstance(frame, bytes):
+        face_locations, face_names = _worker_sfr.detect_known_faces_jpeg(frame, tracker, roi, scale)
+    else:
+        face_locations, face_names = _worker_sfr.detect_known_faces(frame, tracker, roi)
+    return face_locations, face_names, tracker
+
+
+def default_workers():
+    """
+    One worker per core, leaving one core to the event loop
+    """
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+class RecognitionExecutor:
+    """
+    Runs SimpleFacerec.detect_known_faces in a process pool so dlib detection and
+    encoding never block the asyncio event loop.
+
+    Each worker keeps its own copy of the gallery. Whenever the generation of the
+    parent recognizer changes the gallery is published to a temporary directory
+    and workers reload it lazily on their next frame.
+    """
+
+    # Latest published generations kept on disk, older ones only while frames still point to them
+    KEEP_GENERATIONS = 2
+
+    def __init__(self, sfr, max_workers=None):
+        self.sfr = sfr
+        self.max_workers = max_workers or default_workers()
+        self._gallery_dir = tempfile.mkdtemp(prefix='facerec-gallery-')
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self._gallery_dir, True)
+        self._published = []
+        # Frames submitted or waiting to be, by gallery generation
+        self._in_flight = Counter()
+        self._publish_lock = asyncio.Lock()
+        self._pool = self._new_pool()
+
+    def _new_pool(self):
+        settings = {
+            'frame_resizing': self.sfr.frame_resizing,
+            'tolerance': self.sfr.tolerance,
+            'ann_recall': self.sfr.ann_recall,
+            'ann_min_size': self.sfr.ann_min_size,
+        }
+        # spawn: forking a process that runs an event loop and Django threads is not safe
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(settings,),
+        )
+
+    def _publish(self, gallery):
+        prefix = os.path.join(self._gallery_dir, str(gallery.generation))
+        # Write then rename so a worker never loads a partial file
+        with open(prefix + '.encodings.tmp', 'wb') as f:
+            np.save(f, gallery.encodings)
+        with open(prefix + '.names.tmp', 'wb') as f:
+            np.save(f, np.array(gallery.names, dtype=str))
+        os.replace(prefix + '.names.tmp', prefix + '.names.npy')
+        os.replace(prefix + '.encodings.tmp', prefix + '.encodings.npy')
+
+    def _collect(self):
+        # A frame queued in the pool loads its generation whenever a worker picks it up
+        for generation in self._published[:-self.KEEP_GENERATIONS]:
+            if self._in_flight[generation]:
+                continue
+            self._published.remove(generation)
+            old = os.path.join(self._gallery_dir, str(generation))
+            for suffix in ('.encodings.npy', '.names.npy'):
+                try:
+                    os.remove(old + suffix)
+                except OSError:
+                    pass
+
+    async def _ensure_published(self, gallery):
+        if self._published and self._published[-1] == gallery.generation:
+            return
+        async with self._publish_lock:
+            if not self._published or self._published[-1] < gallery.generation:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._publish, gallery)
+                self._published.append(gallery.generation)
+                self._collect()
+
+    async def detect_known_faces(self, frame, tracker=None, roi=None, scale=None):
+        """
+        Awaitable SimpleFacerec.detect_known_faces run in a worker process,
+        tracker is sent along with the frame and updated with the worker's copy
+        :param frame: BGR frame, or the JPEG bytes of the frame which is cheaper to send
+        :param roi: optional region of interest of the camera, see SimpleFacerec.detect_known_faces
+        :param scale: decode scale of the JPEG bytes, see SimpleFacerec.detect_known_faces_jpeg
+        """
+        gallery = self.sfr.snapshot()
+        self._in_flight[gallery.generation] += 1
+        try:
+            await self._ensure_published(gallery)
+            loop = asyncio.get_running_loop()
+            pool = self._pool
+            try:
+                face_locations, face_names, worker_tracker = await loop.run_in_executor(
+                    pool, _detect, frame, self._gallery_dir, gallery.generation, tracker, roi, scale)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed by the OOM killer), start a fresh pool for the next frames,
+                # once for all the frames that were running on the broken one
+                if self._pool is pool:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self._pool = self._new_pool()
+                raise
+        finally:
+            self._in_flight[gallery.generation] -= 1
+            if not self._in_flight[gallery.generation]:
+                del self._in_flight[gallery.generation]
+                self._collect()
+        if tracker is not None:
+            tracker.restore(worker_tracker)
+        return face_locations, face_names
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._finalizer()
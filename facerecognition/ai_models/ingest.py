@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+
+# JPEG decoders can scale by 1/2, 1/4 and 1/8 while decoding (DCT scaling),
+# which is much cheaper than decoding at full size and resizing afterwards
+REDUCED_DECODE_MODES = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+    (1, cv2.IMREAD_COLOR),
+)
+
+
+def decode_frame(jpeg_bytes, scale=1.0, rgb=True):
+    """
+    Decode a JPEG camera frame straight to the detection scale, as RGB
+    :param scale: size of the result relative to the full frame, e.g. 0.25
+    :param rgb: False to keep OpenCV's BGR, e.g. to draw on and encode the frame again
+    :return: RGB image, or None if the bytes are not a readable image
+    """
+    buffer = np.frombuffer(jpeg_bytes, np.uint8)
+    # Largest reduction that does not go below the requested scale
+    factor, mode = next((f, m) for f, m in REDUCED_DECODE_MODES if f * scale <= 1)
+    frame = cv2.imdecode(buffer, mode)
+    if frame is None:
+        return None
+    remaining = scale * factor
+    if remaining < 1:
+        frame = cv2.resize(frame, (0, 0), fx=remaining, fy=remaining, interpolation=cv2.INTER_AREA)
+    if not rgb:
+        return frame
+    # The only colour conversion of the pipeline: BGR (OpenCV) -> RGB (face_recognition)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+
+def crop_roi(frame, roi):
+    """
+    Region of interest of a frame, without copying
+    :param roi: (x, y, width, height) as fractions of the frame size, e.g. (0.25, 0, 0.5, 1)
+    :return: the cropped view and the (top, left) offset of the region in the frame
+    """
+    height, width = frame.shape[:2]
+    x, y, w, h = roi
+    left, top = int(x * width), int(y * height)
+    right, bottom = max(left + 1, int((x + w) * width)), max(top + 1, int((y + h) * height))
+    return frame[top:bottom, left:right], (top, left)
@@ -0,0 +1,69 @@
+import cv2
+import numpy as np
+
+from .ingest import crop_roi
+
+GRAYSCALE_DECODE_MODES = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    (1, cv2.IMREAD_GRAYSCALE),
+)
+
+
+class MotionGate:
+    """
+    Cheap pre-stage before face detection: a frame is compared with the last
+    processed one on a small grayscale thumbnail and only frames with enough
+    change go through detection. Every keyframe_interval frames one goes
+    through anyway, so a person standing still is still seen.
+    """
+
+    def __init__(self, threshold=0.01, keyframe_interval=10, pixel_threshold=25, size=(64, 48), roi=None):
+        # Fraction of thumbnail pixels that must change
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        # Gray level difference for a pixel to count as changed
+        self.pixel_threshold = pixel_threshold
+        self.size = size
+        # Only motion inside the region of interest counts, (x, y, width, height) fractions
+        self.roi = roi
+        self.reference = None
+        self.frames_since_keyframe = 0
+        # JPEG decode reduction, see fit
+        self.reduction = 8
+
+    def fit(self, width):
+        """
+        Decode frames `width` pixels wide at the largest reduction that still covers the thumbnail,
+        small frames captured at the detection size would otherwise be decoded below it
+        """
+        self.reduction = next(f for f, _ in GRAYSCALE_DECODE_MODES if f == 1 or width / f >= self.size[0])
+
+    def thumbnail(self, jpeg_bytes):
+        # Decode at a reduced scale straight from the JPEG, no full size buffer
+        mode = dict(GRAYSCALE_DECODE_MODES)[self.reduction]
+        gray = cv2.imdecode(np.frombuffer(jpeg_bytes, np.uint8), mode)
+        if gray is None:
+            return None
+        if self.roi is not None:
+            gray = crop_roi(gray, self.roi)[0]
+        thumbnail = cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA)
+        # Blur away sensor noise and JPEG artifacts
+        return cv2.GaussianBlur(thumbnail, (5, 5), 0)
+
+    def should_process(self, jpeg_bytes):
+        """
+        :return: True when the frame must go through detection
+        """
+        thumbnail = self.thumbnail(jpeg_bytes)
+        if thumbnail is None:
+            return False
+        self.frames_since_keyframe += 1
+        if self.reference is not None and self.frames_since_keyframe < self.keyframe_interval:
+            changed = np.count_nonzero(cv2.absdiff(thumbnail, self.reference) > self.pixel_threshold)
+            if changed < self.threshold * thumbnail.size:
+                return False
+        self.reference = thumbnail
+        self.frames_since_keyframe = 0
+        return True
@@ -0,0 +1,38 @@
+class PresenceTracker:
+    """
+    Per person enter/exit state machine.
+
+    A recognized person only produces an event on a real transition: the first
+    time they are seen, when the action changes (enter -> exit or back), or when
+    the same action comes back after they were out of sight of the cameras for
+    longer than the cooldown. Someone standing in front of a camera therefore
+    produces one event, not one per frame.
+    """
+
+    def __init__(self):
+        # person id -> [last action, last time the person was seen doing it]
+        self.state = {}
+
+    def load(self, latest_activities):
+        """
+        Rebuild the state from the latest activity of each person
+        :param latest_activities: iterable of (person_id, action, time), time may be None
+        """
+        self.state = {
+            person_id: [action, time]
+            for person_id, action, time in latest_activities
+            if action
+        }
+
+    def transitions(self, person_ids, action, now, cooldown):
+        """
+        :param cooldown: timedelta, same action events closer than this are suppressed
+        :return: the person ids that have to be recorded
+        """
+        changed = []
+        for person_id in person_ids:
+            state = self.state.get(person_id)
+            if state is None or state[0] != action or state[1] is None or now - state[1] >= cooldown:
+                changed.append(person_id)
+            self.state[person_id] = [action, now]
+        return changed
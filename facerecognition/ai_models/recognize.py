@@ -1,6 +1,10 @@
 import cv2
 from matplotlib import pyplot as plt
-from .simple_facerec import SimpleFacerec #for django
+from .simple_facerec import SimpleFacerec, ENCODING_SIZE #for django
+from .ingest import decode_frame
+from .presence import PresenceTracker
+from datetime import timedelta
+from django.conf import settings
 from django.utils import timezone
 from asgiref.sync import sync_to_async
 # Encode faces from a folder
@@ -14,89 +18,190 @@ def encode_face(image_path):
     else:
         return None
 
-def encode_faces(path='images/faces'):
+def new_recognizer():
+    """
+    this function returns an empty SimpleFacerec set up from the FACE_RECOGNITION_ANN_* settings,
+    before its gallery is filled so the index is built with it and the executor workers get the same settings
+    """
+    sfr = SimpleFacerec()
+    sfr.ann_recall = settings.FACE_RECOGNITION_ANN_RECALL
+    sfr.ann_min_size = settings.FACE_RECOGNITION_ANN_MIN_SIZE
+    return sfr
+
+def encode_faces(path='images/faces', store_path=None):
     """
     this function encodes faces from a folder and returns the SimpleFacerec object 
     with the faces encoded in it
+    when store_path is given, encodings are cached there and only new or changed images are encoded
     """
     
-    sfr = SimpleFacerec()
+    sfr = new_recognizer()
     
-    sfr.load_encoding_images(path)
+    sfr.load_encoding_images(path, store_path=store_path)
     print("faces encoded")
     return sfr
 
+def load_faces_from_db():
+    """
+    this function builds the SimpleFacerec gallery from Person.face_encoding in one query,
+    the names are the person ids like the media/faces/<id>.jpg file names
+    """
+    from facerecognition.models import Person
+    import numpy as np
+
+    rows = [
+        (pk, encoding)
+        for pk, encoding in Person.objects.exclude(face_encoding=None).values_list('pk', 'face_encoding')
+        if len(encoding) == ENCODING_SIZE * 4
+    ]
+    sfr = new_recognizer()
+    if rows:
+        encodings = np.frombuffer(b''.join(encoding for _, encoding in rows), dtype=np.float32)
+        sfr.set_known_faces(encodings.reshape(-1, ENCODING_SIZE), [str(pk) for pk, _ in rows])
+    print(f"{len(rows)} faces loaded from the database")
+    return sfr
+
     
 
-async def detect_(sfr, img=None, img_path='', type='enter'):
-    from facerecognition.models import Person, Room, Activity
-    from django.utils import timezone
+# Annotated camera frames are streamed at half the native camera resolution
+ANNOTATION_SCALE = 0.5
+
+def draw_faces(frame, face_locations, face_names, scale=1.0, text_scale=None):
+    """
+    this function draws the names and boxes of the faces on a BGR frame,
+    scale is the size of the frame relative to the one the locations were detected on
+    text_scale is its size relative to the native camera resolution, for the text and line sizes, scale when None
+    """
+    if text_scale is None:
+        text_scale = scale
+    for face_loc, name in zip(face_locations, face_names):
+        y1, x2, y2, x1 = (int(v * scale) for v in face_loc[:4])
+        cv2.putText(frame, name, (x1, y1 - 10), cv2.FONT_HERSHEY_DUPLEX, 2 * text_scale, (0, 0, 200),
+                    max(1, int(4 * text_scale)))
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 200), max(1, int(4 * text_scale)))
+    return frame
+
+def annotate_jpeg(jpeg, face_locations, face_names, capture_scale=1.0):
+    """
+    this function decodes a camera frame at ANNOTATION_SCALE of the native camera resolution, draws the faces on it
+    and encodes it back to JPEG
+    capture_scale is the size of jpeg relative to the native resolution, below 1 once the client captures smaller
+    frames, those are never upscaled
+    """
+    scale = min(1.0, ANNOTATION_SCALE / capture_scale)
+    frame = decode_frame(jpeg, scale, rgb=False)
+    if frame is None:
+        return None
+    draw_faces(frame, face_locations, face_names, scale, scale * capture_scale)
+    return cv2.imencode('.jpg', frame)[1].tobytes()
+
+def load_presence_from_db():
+    """
+    this function rebuilds the PresenceTracker from the latest Activity of each person
+    """
+    from facerecognition.models import Activity
+    from django.db.models import Max
+
+    latest = Activity.objects.filter(
+        pk__in=Activity.objects.values('person').annotate(last=Max('pk')).values('last')
+    ).values_list('person_id', 'action', 'actual_enter_date', 'actual_exit_date')
+    presence = PresenceTracker()
+    presence.load(
+        (person_id, action, actual_enter_date if action == 'enter' else actual_exit_date)
+        for person_id, action, actual_enter_date, actual_exit_date in latest
+    )
+    print(f"presence of {len(presence.state)} persons loaded")
+    return presence
+
+def find_persons(person_ids):
+    """
+    this function loads the persons recognized in a frame with their rooms in one query,
+    in the order they were recognized and without duplicates
+    """
+    from facerecognition.models import Person
+
+    person_ids = list(dict.fromkeys(person_ids))
+    found = Person.objects.select_related('room').in_bulk(person_ids)
+    return [found[pk] for pk in person_ids if pk in found]
+
+def activity_events(people, type='enter'):
+    """
+    this function builds the enter or exit events of the persons, as written by write_behind.write_activities
+    """
+    now = timezone.now().isoformat()
+    return [
+        {
+            'person': person.pk,
+            'room': person.room_id,
+            'action': 'enter' if type == 'enter' else 'exit',
+            'time': now,
+            'enter_date': person.enter_date.isoformat() if person.enter_date else None,
+            'exit_date': person.exit_date.isoformat() if person.exit_date else None,
+        }
+        for person in people
+    ]
+
+def record_activities(person_ids, type='enter'):
+    """
+    this function records the enter or exit activity of the persons recognized in a frame:
+    one query for the persons and their rooms, then one transaction with a bulk insert
+    of the activities and a single update of the rooms whose light has to change
+    """
+    from facerecognition.write_behind import write_activities
+
+    people = find_persons(person_ids)
+    write_activities(activity_events(people, type))
+    return [{'name': person.name, "room": person.room_id} for person in people]
+
+async def detect_(sfr, img=None, img_path='', type='enter', executor=None, tracker=None, jpeg=None, annotate=False,
+                  presence=None, cooldown=timedelta(0), writer=None, roi=None, scale=None,
+                  capture_scale=1.0):
     """
     This function detects faces in an image and returns the image with the faces detected and the names of the detected faces
+    when executor (a RecognitionExecutor or a CameraRecognizer) is given, detection runs in its worker processes instead of the event loop
+    tracker (a FaceTracker) keeps identities across frames of one camera so known faces are not re-encoded every frame
+    jpeg (the encoded frame bytes) is decoded straight at the detection scale, no full size frame is decoded,
+    the returned frame is then the annotated JPEG bytes when annotate is True and None otherwise
+    presence (a PresenceTracker) limits the recorded activities to real enter/exit transitions, with cooldown
+    writer (an ActivityWriteBehind) takes the activity writes off the recognition path
+    roi (x, y, width, height fractions of the frame) limits detection to the region of interest of the camera
+    scale is the one jpeg is decoded at, frame_resizing when None, 1 when the client captured it at the detection size
+    capture_scale is the size of jpeg relative to the native camera resolution, for the annotated frame
     """
+    frame = None
     if img is not None:
         frame = img
     elif img_path:
-        img = cv2.imread(img_path)
-        frame = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        # BGR like camera frames, detect_known_faces does the RGB conversion
+        frame = cv2.imread(img_path)
 
     # Detect Faces
-    face_locations, face_names = sfr.detect_known_faces(frame)
+    if executor is not None:
+        face_locations, face_names = await executor.detect_known_faces(
+            jpeg if jpeg is not None else frame, tracker, roi, scale)
+    elif jpeg is not None:
+        face_locations, face_names = sfr.detect_known_faces_jpeg(jpeg, tracker, roi, scale)
+    else:
+        face_locations, face_names = sfr.detect_known_faces(frame, tracker, roi)
+
+    # Persist the whole frame as one unit of work in a single thread hop
+    person_ids = [int(name) for name in face_names if name.isdigit()]
+    if presence is not None:
+        person_ids = presence.transitions(person_ids, type, timezone.now(), cooldown)
     persons = []
+    if person_ids and writer is not None:
+        people = await sync_to_async(find_persons)(person_ids)
+        writer.enqueue(activity_events(people, type))
+        persons = [{'name': person.name, "room": person.room_id} for person in people]
+    elif person_ids:
+        persons = await sync_to_async(record_activities)(person_ids, type)
+    print('Persons:', persons)
 
-    for face_loc, name in zip(face_locations, face_names):
-        # try:
-        print('Detected person ID:', name)
-
-        # Wrap ORM calls in sync_to_async
-        person = await sync_to_async(Person.objects.get)(pk=int(name))
-        print('Person:', person)
-
-        room = await sync_to_async(lambda: person.room)()
-        # room = await sync_to_async(Room.objects.get)(pk=person.room)
-        print('Room:', room.name)
-        print('type:', type)
-
-        
-
-        # Create activity record
-        if type == 'enter':
-            await sync_to_async(Activity.objects.create)(
-                person=person,
-                room=room,
-                date=timezone.now(),
-                enter_date=person.enter_date,
-                exit_date=person.exit_date,
-                action='enter',
-                actual_enter_date=timezone.now(),
-                actual_exit_date=None,
-            )
-        else:
-            await sync_to_async(Activity.objects.create)(
-                person=person,
-                room=room,
-                date=timezone.now(),
-                enter_date=person.enter_date,
-                exit_date=person.exit_date,
-                action='exit',
-                actual_enter_date=None,
-                actual_exit_date=timezone.now(),
-            )
-        # Update light status
-        room.light_status = True if type == 'enter' else False
-        await sync_to_async(room.save)()
-        print('Light status:', room.light_status)
-        
-        persons.append({'name': person.name, "room": room.id})
-        print('Persons:', persons)
-
-        # except Exception as e:
-        #     print(f"Error processing person {name}:", e)
-        #     pass
-
-        # Draw on the frame
-        y1, x2, y2, x1 = face_loc[0], face_loc[1], face_loc[2], face_loc[3]
-        cv2.putText(frame, name, (x1, y1 - 10), cv2.FONT_HERSHEY_DUPLEX, 2, (0, 0, 200), 4)
-        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 200), 4)
+    # Draw on the frame, camera streams only pay for it when someone watches
+    if frame is not None:
+        draw_faces(frame, face_locations, face_names)
+    elif jpeg is not None and annotate:
+        frame = await sync_to_async(annotate_jpeg, thread_sensitive=False)(
+            jpeg, face_locations, face_names, capture_scale)
 
     return frame, persons
\ No newline at end of file
@@ -0,0 +1,153 @@
+import asyncio
+from collections import Counter
+
+# Weights are floored to this, a zero or negative weight would have no share at all
+MIN_WEIGHT = 0.01
+
+
+class FrameExpired(Exception):
+    """
+    The frame waited so long for a worker that its result would come past the deadline
+    """
+
+    def __init__(self, waited):
+        super().__init__(f"frame dropped after waiting {waited:.2f}s for a worker")
+        self.waited = waited
+
+
+class FairScheduler:
+    """
+    Shares the workers of a RecognitionExecutor between cameras.
+
+    At most `slots` frames run at a time, one per worker, the others wait.
+    Every camera accumulates the frames it was served divided by its weight,
+    and the waiting frame of the camera with the least of it goes next: a
+    camera with weight 2 gets twice the frames of a camera with weight 1
+    when the workers are saturated, and a camera sending more often does not
+    take the share of the others. A camera coming back from idle starts at
+    the level of the busy ones instead of catching up on what it missed.
+
+    A waiting frame whose wait plus the usual processing time would exceed
+    the deadline is dropped with FrameExpired instead of being processed
+    late, so an overload shows up as dropped frames, not as latency. A
+    dropped frame costs its camera nothing, so its next frame goes first.
+    """
+
+    def __init__(self, executor, slots=None, deadline=None, smoothing=0.2, idle_after=1.0, clock=None):
+        self.executor = executor
+        # Seconds, the event loop's clock by default
+        self.clock = clock or (lambda: asyncio.get_running_loop().time())
+        self.slots = slots or executor.max_workers
+        # Seconds, None to never drop
+        self.deadline = deadline
+        self.smoothing = smoothing
+        # Moving average of the time a frame spends in a worker
+        self.service_time = 0.0
+        # Camera key -> frames served / weight
+        self.served = {}
+        # Camera key -> frames in a worker
+        self.running = Counter()
+        # Camera key -> when it last had a frame served or dropped, cameras quiet for idle_after seconds are idle
+        self.last_seen = {}
+        self.idle_after = idle_after
+        self.in_flight = 0
+        # (camera key, weight, time enqueued, future) of the waiting frames
+        self.waiting = []
+
+    def camera(self, key, weight=1.0):
+        return CameraRecognizer(self, key, weight)
+
+    async def acquire(self, key, weight):
+        """
+        Wait for a worker slot
+        :return: seconds waited
+        :raise FrameExpired: when the frame was dropped
+        """
+        loop = asyncio.get_running_loop()
+        if self.clock() - self.last_seen.get(key, float('-inf')) > self.idle_after:
+            self.served[key] = max(self.served.get(key, 0.0), self.active_level(key))
+        if self.in_flight < self.slots and not self.waiting:
+            self._start(key, weight)
+            return 0.0
+        granted = loop.create_future()
+        self.waiting.append((key, weight, self.clock(), granted))
+        self._dispatch()
+        try:
+            return await granted
+        except asyncio.CancelledError:
+            # Cancelled right after being granted a slot: give it to the next frame
+            if granted.done() and not granted.cancelled() and granted.exception() is None:
+                self.release(key)
+            raise
+
+    def active_level(self, key):
+        # Least served level of the other cameras currently using the workers
+        levels = [self.served[k] for k in self.running if k != key]
+        levels += [self.served[entry[0]] for entry in self.waiting if entry[0] != key]
+        return min(levels, default=0.0)
+
+    def _start(self, key, weight):
+        self.served[key] += 1 / max(weight, MIN_WEIGHT)
+        self.running[key] += 1
+        self.in_flight += 1
+
+    def release(self, key):
+        self.last_seen[key] = self.clock()
+        self.running[key] -= 1
+        if not self.running[key]:
+            del self.running[key]
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        if not self.waiting:
+            return
+        # Frames of consumers that went away
+        self.waiting = [entry for entry in self.waiting if not entry[3].done()]
+        now = self.clock()
+        while self.in_flight < self.slots and self.waiting:
+            # A handful of cameras wait at most, a scan is cheaper than keeping a heap in order
+            entry = min(self.waiting, key=lambda entry: self.served[entry[0]])
+            self.waiting.remove(entry)
+            key, weight, enqueued, granted = entry
+            waited = now - enqueued
+            if self.deadline is not None and waited + self.service_time > self.deadline:
+                self.last_seen[key] = now
+                granted.set_exception(FrameExpired(waited))
+                continue
+            self._start(key, weight)
+            granted.set_result(waited)
+
+    async def detect_known_faces(self, key, weight, frame, tracker=None, roi=None, scale=None):
+        waited = await self.acquire(key, weight)
+        started = self.clock()
+        try:
+            result = await self.executor.detect_known_faces(frame, tracker, roi, scale)
+        finally:
+            elapsed = self.clock() - started
+            self.service_time += self.smoothing * (elapsed - self.service_time)
+            self.release(key)
+        return result, waited
+
+
+class CameraRecognizer:
+    """
+    What a camera uses as its executor: RecognitionExecutor.detect_known_faces
+    through the FairScheduler, with the weight of the camera
+    """
+
+    def __init__(self, scheduler, key, weight=1.0):
+        self.scheduler = scheduler
+        self.key = key
+        self.weight = weight
+        # Seconds the last frame waited for a worker
+        self.last_wait = 0.0
+
+    async def detect_known_faces(self, frame, tracker=None, roi=None, scale=None):
+        try:
+            result, self.last_wait = await self.scheduler.detect_known_faces(
+                self.key, self.weight, frame, tracker, roi, scale)
+        except FrameExpired as e:
+            self.last_wait = e.waited
+            raise
+        return result
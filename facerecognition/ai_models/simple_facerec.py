@@ -2,21 +2,146 @@ import face_recognition
 import cv2
 import os
 import glob
+import threading
 import numpy as np
 from matplotlib import pyplot as plt
+from .encoding_store import EncodingStore, content_hash
+from .ann_index import IVFIndex, sq_distances
+from .ingest import crop_roi, decode_frame
+
+# Size of the face embedding produced by the dlib ResNet encoder
+ENCODING_SIZE = 128
+
+
+class Gallery:
+    """
+    Immutable snapshot of the known faces.
+    Updates build a new Gallery and swap it in, so a frame that grabbed a
+    snapshot keeps matching against consistent encodings and names.
+    """
+
+    def __init__(self, encodings, names, generation=0):
+        encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if len(encodings) != len(names):
+            raise ValueError("encodings and names must have the same length")
+        encodings.flags.writeable = False
+        self.encodings = encodings
+        self.names = tuple(names)
+        self.sq_norms = np.einsum('ij,ij->i', encodings, encodings)
+        self.index = {name: row for row, name in enumerate(self.names)}
+        self.generation = generation
+        # Optional IVFIndex for approximate search, set by SimpleFacerec
+        self.ann = None
+
+    def __len__(self):
+        return len(self.names)
+
 
 class SimpleFacerec:
     def __init__(self):
-        self.known_face_encodings = []
-        self.known_face_names = []
+        # Known encodings are kept as one contiguous float32 (N, 128) matrix
+        # so every face in a frame is matched with a single batched product
+        self._gallery = Gallery(np.empty((0, ENCODING_SIZE), dtype=np.float32), [])
+        self._gallery_lock = threading.Lock()
 
         # Resize frame for a faster speed
         self.frame_resizing = 0.25
 
-    def load_encoding_images(self, images_path):
+        # Same default as face_recognition.compare_faces
+        self.tolerance = 0.6
+
+        # Approximate search for large galleries: recall target of the IVF index,
+        # None to always search exactly. Smaller galleries are searched exactly anyway.
+        self.ann_recall = None
+        self.ann_min_size = 10000
+
+    @property
+    def known_face_encodings(self):
+        return self._gallery.encodings
+
+    @property
+    def known_face_names(self):
+        return list(self._gallery.names)
+
+    @property
+    def generation(self):
+        return self._gallery.generation
+
+    def _new_gallery(self, encodings, names, rebuild_index=False, generation=None):
+        previous = self._gallery
+        gallery = Gallery(encodings, names, previous.generation + 1 if generation is None else generation)
+        if self.ann_recall is not None and len(gallery) >= self.ann_min_size:
+            # Retrain the partitions once the gallery has doubled since the last training
+            if rebuild_index or previous.ann is None or len(gallery) > 2 * previous.ann.trained_size:
+                gallery.ann = IVFIndex.train(gallery.encodings, recall=self.ann_recall)
+            else:
+                gallery.ann = previous.ann.with_encodings(gallery.encodings)
+        return gallery
+
+    def rebuild_index(self):
+        """
+        Retrain the approximate index, e.g. after changing ann_recall
+        """
+        with self._gallery_lock:
+            gallery = self._gallery
+            self._gallery = self._new_gallery(gallery.encodings, gallery.names, rebuild_index=True)
+
+    def snapshot(self):
+        """
+        Current gallery, to match a whole frame against the same faces
+        """
+        return self._gallery
+
+    def set_known_faces(self, encodings, names, generation=None):
+        """
+        Replace the gallery with the given encodings and names
+        :param encodings: array-like of shape (N, 128)
+        :param names: list of N names
+        :param generation: generation of the new gallery, the next one by default.
+                           Recognition workers take the generation of the gallery they copy
+        """
+        with self._gallery_lock:
+            self._gallery = self._new_gallery(encodings, names, generation=generation)
+
+    def add_face(self, name, encoding):
+        """
+        Add a face to the gallery, or replace the encoding of an already known name
+        """
+        encoding = np.asarray(encoding, dtype=np.float32).reshape(1, ENCODING_SIZE)
+        with self._gallery_lock:
+            gallery = self._gallery
+            row = gallery.index.get(name)
+            if row is None:
+                encodings = np.vstack([gallery.encodings, encoding])
+                names = gallery.names + (name,)
+            else:
+                encodings = gallery.encodings.copy()
+                encodings[row] = encoding
+                names = gallery.names
+            self._gallery = self._new_gallery(encodings, names)
+
+    def remove_face(self, name):
+        """
+        Remove a face from the gallery
+        :return: True if the name was known
+        """
+        with self._gallery_lock:
+            gallery = self._gallery
+            row = gallery.index.get(name)
+            if row is None:
+                return False
+            self._gallery = self._new_gallery(
+                np.delete(gallery.encodings, row, axis=0),
+                gallery.names[:row] + gallery.names[row + 1:],
+            )
+            return True
+
+    def load_encoding_images(self, images_path, store_path=None):
         """
         Load encoding images from path
         :param images_path:
+        :param store_path: optional EncodingStore directory, images whose content
+                           is already in the store are not encoded again
         :return:
         """
         # Load Images
@@ -24,56 +149,176 @@ class SimpleFacerec:
 
         print("{} encoding images found.".format(len(images_path)))
 
+        store = EncodingStore(store_path) if store_path else None
+        entries = {}
+        encoded = 0
+        cached = 0
+
         # Store image encoding and names
+        encodings = []
+        names = []
         for img_path in images_path:
-            img = cv2.imread(img_path)
-            rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            # show image
-            # plt.imshow(rgb_img)
-            # plt.show()
+            with open(img_path, 'rb') as f:
+                data = f.read()
+            key = content_hash(data)
 
             # Get the filename only from the initial file path.
             basename = os.path.basename(img_path)
             (filename, ext) = os.path.splitext(basename)
-            # Get encoding
-            faccee=face_recognition.face_encodings(rgb_img)
-            if len(faccee) <= 0:
+
+            if key in entries:
+                img_encoding = entries[key]
+            elif store is not None and key in store:
+                img_encoding = store[key]
+                cached += 1
+            else:
+                img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+                if img is None:
+                    print(f"could not read {filename}")
+                    continue
+                rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                # show image
+                # plt.imshow(rgb_img)
+                # plt.show()
+
+                # Get encoding
+                faccee=face_recognition.face_encodings(rgb_img)
+                img_encoding = faccee[0] if len(faccee) > 0 else None
+                encoded += 1
+            entries[key] = img_encoding
+            if img_encoding is None:
                 print(f"no face found in {filename}")
                 continue
-            img_encoding =faccee [0]
 
             # Store file name and file encoding
-            self.known_face_encodings.append(img_encoding)
-            self.known_face_names.append(filename)
+            encodings.append(img_encoding)
+            names.append(filename)
+
+        # Only rewrite the store when images were added, changed or removed
+        if store is not None and (encoded or set(entries) != set(store.keys())):
+            store.save(entries)
+        print(f"{encoded} images encoded, {cached} loaded from the store")
+
+        self.set_known_faces(
+            np.vstack([self.known_face_encodings] + encodings) if encodings else self.known_face_encodings,
+            self.known_face_names + names,
+        )
         print("Encoding images loaded")
 
-    def detect_known_faces(self, frame):
+    def match_faces(self, face_encodings, gallery=None):
+        """
+        Match all the faces of a frame against the gallery in one pass
+        :param face_encodings: array-like of shape (F, 128)
+        :param gallery: snapshot to match against, the current one by default
+        :return: (best_index, best_distance, margin) arrays of length F.
+                 margin is the gap between the best and the second best distance,
+                 best_index is -1 when the gallery is empty
+        """
+        if gallery is None:
+            gallery = self._gallery
+        faces = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        n_faces = len(faces)
+        n_known = len(gallery)
+        if n_faces == 0 or n_known == 0:
+            return (np.full(n_faces, -1, dtype=np.intp),
+                    np.full(n_faces, np.inf, dtype=np.float32),
+                    np.full(n_faces, np.inf, dtype=np.float32))
+
+        if gallery.ann is not None:
+            best_index, best_sq, second_sq = gallery.ann.search(faces, gallery.encodings, gallery.sq_norms)
+            best_distance = np.sqrt(best_sq)
+            return best_index, best_distance, np.sqrt(second_sq) - best_distance
+
+        # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b  -> one (F, N) matrix product
+        sq_dist = sq_distances(faces, gallery.encodings, gallery.sq_norms)
+
+        rows = np.arange(n_faces)
+        if n_known == 1:
+            best_index = np.zeros(n_faces, dtype=np.intp)
+            best_distance = np.sqrt(sq_dist[:, 0])
+            margin = np.full(n_faces, np.inf, dtype=np.float32)
+        else:
+            # Two smallest distances per face without a full sort
+            top2 = np.argpartition(sq_dist, 1, axis=1)[:, :2]
+            top2_dist = sq_dist[rows[:, None], top2]
+            order = np.argsort(top2_dist, axis=1)
+            best_index = top2[rows, order[:, 0]]
+            best_distance = np.sqrt(top2_dist[rows, order[:, 0]])
+            margin = np.sqrt(top2_dist[rows, order[:, 1]]) - best_distance
+        return best_index, best_distance, margin
+
+    def detect_known_faces(self, frame, tracker=None, roi=None):
+        """
+        :param frame: full size BGR frame
+        :param tracker: optional FaceTracker of the camera, faces that are already
+                        identified are then not encoded again on every frame
+        :param roi: optional (x, y, width, height) fractions of the frame, faces are only looked for there
+        """
         small_frame = cv2.resize(frame, (0, 0), fx=self.frame_resizing, fy=self.frame_resizing)
-        # Find all the faces and face encodings in the current frame of video
         # Convert the image from BGR color (which OpenCV uses) to RGB color (which face_recognition uses)
         rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+        return self.detect_known_faces_roi(rgb_small_frame, tracker, roi)
+
+    def detect_known_faces_jpeg(self, jpeg_bytes, tracker=None, roi=None, scale=None):
+        """
+        Same as detect_known_faces for an encoded camera frame, decoded straight at frame_resizing scale
+        :param scale: decode at this scale instead, e.g. 1 for frames the client already captured at the detection size
+        """
+        scale = scale or self.frame_resizing
+        rgb_small_frame = decode_frame(jpeg_bytes, scale)
+        if rgb_small_frame is None:
+            raise ValueError("could not decode the frame")
+        return self.detect_known_faces_roi(rgb_small_frame, tracker, roi, scale)
+
+    def detect_known_faces_roi(self, rgb_small_frame, tracker=None, roi=None, scale=None):
+        """
+        detect_known_faces_rgb on the region of interest only, face locations stay in full frame coordinates
+        """
+        if roi is None:
+            return self.detect_known_faces_rgb(rgb_small_frame, tracker, scale)
+        scale = scale or self.frame_resizing
+        region, (top, left) = crop_roi(rgb_small_frame, roi)
+        face_locations, face_names = self.detect_known_faces_rgb(region, tracker, scale)
+        if len(face_locations):
+            # (top, right, bottom, left) of the region back to the full frame
+            face_locations = face_locations + (np.array([top, left, top, left]) / scale).astype(int)
+        return face_locations, face_names
+
+    def detect_known_faces_rgb(self, rgb_small_frame, tracker=None, scale=None):
+        """
+        :param rgb_small_frame: RGB frame already resized by frame_resizing
+        :param scale: the frame was resized by this instead of frame_resizing
+        :return: face locations scaled back to the full frame and the face names
+        """
+        # Find all the faces and face encodings in the current frame of video
         face_locations = face_recognition.face_locations(rgb_small_frame)
-        face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
-
-        face_names = []
-        for face_encoding in face_encodings:
-            # See if the face is a match for the known face(s)
-            matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding)
-            name = "Unknown"
-
-            # # If a match was found in known_face_encodings, just use the first one.
-            # if True in matches:
-            #     first_match_index = matches.index(True)
-            #     name = known_face_names[first_match_index]
-
-            # Or instead, use the known face with the smallest distance to the new face
-            face_distances = face_recognition.face_distance(self.known_face_encodings, face_encoding)
-            best_match_index = np.argmin(face_distances)
-            if matches[best_match_index]:
-                name = self.known_face_names[best_match_index]
-            face_names.append(name)
+        gallery = self._gallery
+
+        if tracker is not None:
+            tracks = tracker.update(face_locations, gallery.generation)
+            to_identify = [i for i, track in enumerate(tracks) if tracker.needs_identity(track)]
+        else:
+            to_identify = range(len(face_locations))
+
+        face_encodings = face_recognition.face_encodings(
+            rgb_small_frame, [face_locations[i] for i in to_identify])
+
+        # Use the known face with the smallest distance to each new face,
+        # as long as it is within tolerance
+        best_index, best_distance, margin = self.match_faces(face_encodings, gallery)
+        names = [
+            gallery.names[index] if index >= 0 and distance <= self.tolerance else "Unknown"
+            for index, distance in zip(best_index, best_distance)
+        ]
+
+        if tracker is not None:
+            for i, name in zip(to_identify, names):
+                tracker.identify(tracks[i], name)
+            face_names = [track.name for track in tracks]
+        else:
+            face_names = names
 
         # Convert to numpy array to adjust coordinates with frame resizing quickly
         face_locations = np.array(face_locations)
-        face_locations = face_locations / self.frame_resizing
+        face_locations = face_locations / (scale or self.frame_resizing)
         return face_locations.astype(int), face_names
@@ -0,0 +1,112 @@
+def iou(box_a, box_b):
+    """
+    Intersection over union of two (top, right, bottom, left) boxes
+    """
+    top, right = max(box_a[0], box_b[0]), min(box_a[1], box_b[1])
+    bottom, left = min(box_a[2], box_b[2]), max(box_a[3], box_b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    if intersection == 0:
+        return 0.0
+    area_a = (box_a[1] - box_a[3]) * (box_a[2] - box_a[0])
+    area_b = (box_b[1] - box_b[3]) * (box_b[2] - box_b[0])
+    return intersection / float(area_a + area_b - intersection)
+
+
+class Track:
+    def __init__(self, box):
+        self.box = box
+        self.name = None
+        # Frames since the face was last encoded and matched
+        self.age = 0
+        # Consecutive frames the face was not detected
+        self.missed = 0
+
+
+class FaceTracker:
+    """
+    Associates face boxes between consecutive frames of one camera by IoU and keeps
+    the identity of each track, so the 128-d encoding and gallery match only run
+    for new tracks and every reidentify_every frames for known ones.
+
+    The tracker is plain data: it is pickled to the recognition worker with the frame
+    and the updated copy is restored into the consumer's tracker.
+    """
+
+    def __init__(self, iou_threshold=0.3, reidentify_every=10, max_missed=2):
+        self.iou_threshold = iou_threshold
+        self.reidentify_every = reidentify_every
+        self.max_missed = max_missed
+        self.tracks = []
+        # Gallery generation the identities were matched against
+        self.generation = None
+        # Faces detected and faces actually encoded, to see how much the tracker saves
+        self.faces = 0
+        self.encoded = 0
+
+    def update(self, face_locations, generation=None):
+        """
+        Associate the faces detected in a frame with the current tracks
+        :param face_locations: list of (top, right, bottom, left) boxes
+        :param generation: generation of the gallery used for matching, a new
+                           generation makes every track identify again
+        :return: the track of each face, in the order of face_locations
+        """
+        if generation != self.generation:
+            self.generation = generation
+            for track in self.tracks:
+                track.name = None
+
+        # Greedy association, best overlapping pairs first
+        pairs = sorted(
+            ((iou(track.box, box), t, f)
+             for t, track in enumerate(self.tracks)
+             for f, box in enumerate(face_locations)),
+            reverse=True,
+        )
+        face_tracks = [None] * len(face_locations)
+        matched_tracks = set()
+        for overlap, t, f in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if t in matched_tracks or face_tracks[f] is not None:
+                continue
+            matched_tracks.add(t)
+            track = self.tracks[t]
+            track.box = face_locations[f]
+            track.age += 1
+            track.missed = 0
+            face_tracks[f] = track
+
+        # Lost tracks are kept a few frames in case the detector missed the face
+        tracks = []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    continue
+            tracks.append(track)
+
+        for f, box in enumerate(face_locations):
+            if face_tracks[f] is None:
+                face_tracks[f] = Track(box)
+                tracks.append(face_tracks[f])
+        self.tracks = tracks
+        self.faces += len(face_locations)
+        return face_tracks
+
+    def needs_identity(self, track):
+        return track.name is None or track.age >= self.reidentify_every
+
+    def identify(self, track, name):
+        track.name = name
+        track.age = 0
+        self.encoded += 1
+
+    def restore(self, other):
+        """
+        Take over the state of the copy updated by a recognition worker
+        """
+        self.tracks = other.tracks
+        self.generation = other.generation
+        self.faces = other.faces
+        self.encoded = other.encoded
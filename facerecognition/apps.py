@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class FaceRecognitionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'facerecognition'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,55 @@
+import time
+from collections import defaultdict, deque
+
+
+class CameraThroughput:
+    """
+    Frame counters of one camera across its connections, the rate of frames
+    that went through recognition and the time frames waited for a worker,
+    over the last window seconds
+    """
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self.counters = {'received': 0, 'processed': 0, 'dropped': 0, 'skipped': 0, 'expired': 0}
+        self.processed_at = deque()
+        # (time, seconds waited for a worker)
+        self.waits = deque()
+
+    def count(self, name):
+        self.counters[name] += 1
+        if name == 'processed':
+            self.processed_at.append(time.monotonic())
+
+    def record_wait(self, seconds):
+        self.waits.append((time.monotonic(), seconds))
+
+    def _trim(self):
+        horizon = time.monotonic() - self.window
+        while self.processed_at and self.processed_at[0] < horizon:
+            self.processed_at.popleft()
+        while self.waits and self.waits[0][0] < horizon:
+            self.waits.popleft()
+
+    @property
+    def fps(self):
+        self._trim()
+        return len(self.processed_at) / self.window
+
+    def queue_wait_ms(self):
+        """
+        :return: average and longest wait for a worker over the window, in milliseconds
+        """
+        self._trim()
+        waits = [seconds for _, seconds in self.waits]
+        if not waits:
+            return 0.0, 0.0
+        return round(sum(waits) / len(waits) * 1e3, 1), round(max(waits) * 1e3, 1)
+
+    def as_dict(self):
+        average, longest = self.queue_wait_ms()
+        return dict(self.counters, fps=round(self.fps, 2), queue_wait_ms=average, max_queue_wait_ms=longest)
+
+
+# Camera id -> CameraThroughput, for the cameras streaming to this process
+camera_throughput = defaultdict(CameraThroughput)
@@ -1,74 +1,307 @@
+import asyncio
 import json
-import cv2
-import numpy as np
+from collections import Counter
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from facerecognition.ai_models.recognize import encode_faces, detect_
+from django.conf import settings
+from facerecognition.ai_models.recognize import encode_faces, load_faces_from_db, load_presence_from_db, detect_
+from facerecognition.ai_models.capture import CaptureSize
+from facerecognition.ai_models.executor import RecognitionExecutor
+from facerecognition.ai_models.scheduler import FairScheduler, FrameExpired
+from facerecognition.ai_models.tracker import FaceTracker
+from facerecognition.ai_models.motion import MotionGate
+from facerecognition.signals import register_recognizer
+from facerecognition.room_state import ROOMS_GROUP, rooms_snapshot
+from facerecognition.write_behind import ActivityWriteBehind
+from facerecognition.camera_stats import camera_throughput
+from facerecognition.models import Camera
 
-# Encode all faces at startup
-sfr = encode_faces('media/faces')
+# Load the gallery from the stored encodings at startup,
+# falling back to encoding the face images when the database has none
+sfr = load_faces_from_db()
+if not sfr.known_face_names:
+    sfr = encode_faces('media/faces', store_path='media/encodings')
+# Follow people added, updated or deleted while the server is running
+register_recognizer(sfr)
 
-async def recognize_person_channel(frame, type):
-    # Await the asynchronous detect_ function
-    frame, face_names = await detect_(sfr, img=frame, type=type)
+# Detection and encoding run in worker processes, each with a warm copy of the gallery
+executor = RecognitionExecutor(sfr, max_workers=settings.FACE_RECOGNITION_WORKERS)
+# The workers are shared between the cameras by weight, frames waiting past the deadline are dropped
+scheduler = FairScheduler(executor, deadline=settings.FACE_RECOGNITION_FRAME_DEADLINE)
+
+# Who is in and who is out, so a person standing at a camera is recorded once
+presence = load_presence_from_db()
+
+# Activities are written in batches off the recognition path,
+# after replaying the ones a previous process left in the journal
+writer = ActivityWriteBehind(
+    settings.FACE_RECOGNITION_WRITE_JOURNAL,
+    batch_size=settings.FACE_RECOGNITION_WRITE_BATCH_SIZE,
+    interval=settings.FACE_RECOGNITION_WRITE_INTERVAL,
+)
+writer.recover()
+
+# Number of clients subscribed to the annotated frames of each camera, by camera id
+annotated_viewers = Counter()
+
+async def recognize_person_channel(jpeg, camera, tracker=None, annotate=False, roi=None, recognizer=executor,
+                                   scale=None, capture_scale=1.0):
+    # Await the asynchronous detect_ function, the frame is decoded in the worker at detection scale
+    frame, face_names = await detect_(sfr, type=camera.direction, executor=recognizer, tracker=tracker, jpeg=jpeg,
+                                      annotate=annotate, presence=presence, cooldown=camera.get_cooldown(),
+                                      writer=writer, roi=roi, scale=scale, capture_scale=capture_scale)
     return frame, face_names
 
 
-class EnterCameraVideoStreamConsumer(AsyncWebsocketConsumer):
+def find_camera(camera_id=None, direction=None):
+    """
+    The camera of a connection: by id, or the first one with the direction for the legacy endpoints
+    """
+    cameras = Camera.objects.all()
+    if camera_id is not None:
+        return cameras.filter(pk=camera_id).first()
+    return cameras.filter(direction=direction).order_by('pk').first()
+
+
+class CameraVideoStreamConsumer(AsyncWebsocketConsumer):
+    """
+    Receives the frames of a registered Camera and replies with the recognized persons.
+    Every camera shares the recognizer gallery and the worker pool of the process.
+
+    Frames are kept in a single slot: when a newer frame arrives before the
+    previous one was picked up for processing, the older one is dropped, so
+    the reported events never lag more than one frame behind the camera.
+    At most frame_budget frames per second of the camera are picked up.
+
+    The capture client is paced by credits: it may only send a frame while it
+    holds one. On connect it gets {"type": "flow", "credits": N, "interval": ms},
+    and every frame returns its credit once it is done with, in the reply to
+    the frame or in a flow message for a dropped one. interval is the
+    spacing between captures the camera can currently keep up with, from its
+    frame budget and the measured time to answer a frame. Frames sent without
+    a credit are dropped, and no credit comes back for them.
+
+    A client sending {"capture": {"width": w, "height": h}}, its full
+    resolution, is told the size and JPEG quality to capture at with
+    {"type": "capture", "capture": {"width", "height", "quality"}}: the
+    detection size, raised while the faces seen are small. Changes come in
+    the "capture" key of a reply. Its frames are then decoded as they are,
+    frames of clients that never tell are full size and shrunk on decode.
+
+    Clients sending {"subscribe": "annotated"} also receive the frames of the
+    camera with the faces drawn on them, as binary JPEG messages. A frame is
+    only drawn and encoded when someone is subscribed, once for all of them.
+    """
+
+    @property
+    def annotated_group(self):
+        return f"annotated_camera_{self.camera.pk}"
+
     async def connect(self):
+        route = self.scope['url_route']['kwargs']
+        self.camera = await database_sync_to_async(find_camera)(route.get('camera_id'), route.get('direction'))
+        if self.camera is None:
+            await self.close()
+            return
+        self.roi = self.camera.get_roi()
+        self.frame_interval = 1 / self.camera.frame_budget if self.camera.frame_budget > 0 else 0
+        self.next_frame_at = 0
+        self.pending_frame = None
+        self.frame_ready = asyncio.Event()
+        # Moving average of the seconds from picking a frame up to answering it
+        self.turnaround = 0.0
+        self.stats = {'received': 0, 'processed': 0, 'dropped': 0, 'skipped': 0, 'expired': 0}
+        self.throughput = camera_throughput[self.camera.pk]
+        self.recognizer = scheduler.camera(self.camera.pk, self.camera.weight)
+        self.capture = CaptureSize(
+            sfr.frame_resizing,
+            min_face=settings.FACE_RECOGNITION_MIN_FACE_SIZE,
+            quality=settings.FACE_RECOGNITION_CAPTURE_QUALITY,
+        )
+        # Scale the frames are decoded at, frame_resizing until the client captures at the detection size
+        self.decode_scale = None
+        # Identities of the faces in front of this camera, across frames
+        self.tracker = FaceTracker()
+        # Frames without motion skip detection and reuse the previous result
+        self.motion_gate = MotionGate(
+            threshold=settings.FACE_RECOGNITION_MOTION_THRESHOLD,
+            keyframe_interval=settings.FACE_RECOGNITION_KEYFRAME_INTERVAL,
+            roi=self.roi,
+        )
+        self.persons = []
+        self.annotated = False
+        # Credits the client holds, every credit given back in flow() is one more frame it may send
+        self.credits = 0
+        self.processing_task = asyncio.create_task(self.process_frames())
         await self.accept()
-        print("Enter WebSocket connection accepted")
+        await self.send(text_data=json.dumps(dict(type='flow', **self.flow(settings.FACE_RECOGNITION_CAPTURE_CREDITS))))
+        print(f"{self.camera} WebSocket connection accepted")
 
     async def disconnect(self, close_code):
-        print("Enter WebSocket connection closed:", close_code)
+        if getattr(self, 'camera', None) is None:
+            return
+        self.processing_task.cancel()
+        await self.unsubscribe_annotated()
+        print(f"{self.camera} WebSocket connection closed:", close_code, self.stats)
+
+    def count(self, name):
+        self.stats[name] += 1
+        self.throughput.count(name)
+
+    def flow(self, credits):
+        # Credits given back to the client, with the capture interval in milliseconds
+        self.credits += credits
+        return {'credits': credits, 'interval': round(max(self.frame_interval, self.turnaround) * 1000)}
 
     async def receive(self, text_data=None, bytes_data=None):
+        if text_data:
+            try:
+                message = json.loads(text_data)
+            except ValueError:
+                return
+            if message.get('subscribe') == 'annotated':
+                await self.subscribe_annotated()
+            elif message.get('unsubscribe') == 'annotated':
+                await self.unsubscribe_annotated()
+            elif 'capture' in message:
+                await self.negotiate_capture(message['capture'])
         if bytes_data:
-            # Decode the incoming frame into an image
-            nparr = np.frombuffer(bytes_data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            self.count('received')
+            if self.credits <= 0:
+                # The client did not wait for a credit
+                self.count('dropped')
+                return
+            self.credits -= 1
+            if self.pending_frame is not None:
+                self.count('dropped')
+                await self.send(text_data=json.dumps(dict(type='flow', **self.flow(1))))
+            # Latest frame wins
+            self.pending_frame = bytes_data
+            self.frame_ready.set()
+
+    async def negotiate_capture(self, native):
+        try:
+            width, height = int(native['width']), int(native['height'])
+        except (KeyError, TypeError, ValueError):
+            return
+        if width <= 0 or height <= 0:
+            return
+        self.capture.set_native(width, height)
+        await self.send(text_data=json.dumps({'type': 'capture', 'capture': self.capture_changed()}))
 
+    def capture_changed(self):
+        # Frames come at the detection size from now on, they are decoded as they are
+        self.decode_scale = 1.0
+        self.motion_gate.fit(self.capture.width)
+        return self.capture.as_dict()
+
+    async def subscribe_annotated(self):
+        if not self.annotated:
+            self.annotated = True
+            annotated_viewers[self.camera.pk] += 1
+            await self.channel_layer.group_add(self.annotated_group, self.channel_name)
+
+    async def unsubscribe_annotated(self):
+        if self.annotated:
+            self.annotated = False
+            annotated_viewers[self.camera.pk] -= 1
+            await self.channel_layer.group_discard(self.annotated_group, self.channel_name)
+
+    async def annotated_frame(self, event):
+        await self.send(bytes_data=event['jpeg'])
+
+    async def process_frames(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.frame_ready.wait()
+            # Within the frame budget, frames arriving meanwhile replace the pending one
+            delay = self.next_frame_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.frame_ready.clear()
+            self.next_frame_at = loop.time() + self.frame_interval
+            bytes_data, self.pending_frame = self.pending_frame, None
+            started = loop.time()
+            try:
+                response = await self.process_frame(bytes_data)
+            except Exception as e:
+                print(f"Error processing {self.camera} frame:", e)
+                response = {'type': 'flow'}
+            self.turnaround += 0.2 * (loop.time() - started - self.turnaround)
+            # The frame is answered, its credit goes back to the client
+            await self.send(text_data=json.dumps(dict(response, **self.flow(1))))
+
+    async def process_frame(self, bytes_data):
+        """
+        :return: the reply to the frame
+        """
+        capture = None
+        if self.motion_gate.should_process(bytes_data):
             # Process the frame
-            frame, persons = await recognize_person_channel(frame, 'enter')
-            image = None
-            
-            if persons:
-                image = "media/simu/house_imageON.jpg"
-                # if self.TRIGGER else "media/simu/house_imageOFF.jpg"
-
-            response = {
-                "image": image,
-                "faces": len(persons),
-                "persons": persons
-            }
-
-            await self.send(text_data=json.dumps(response))
-            
-class ExitCameraVideoStreamConsumer(AsyncWebsocketConsumer):
+            annotate = annotated_viewers[self.camera.pk] > 0
+            try:
+                frame, self.persons = await recognize_person_channel(
+                    bytes_data, self.camera, self.tracker, annotate=annotate, roi=self.roi,
+                    recognizer=self.recognizer, scale=self.decode_scale,
+                    capture_scale=1.0 if self.decode_scale is None else self.capture.scale)
+            except FrameExpired:
+                self.throughput.record_wait(self.recognizer.last_wait)
+                self.count('expired')
+                # The frame was never looked at, the next one must not be compared against it
+                self.motion_gate.reference = None
+            else:
+                self.throughput.record_wait(self.recognizer.last_wait)
+                self.count('processed')
+                # Track boxes are in pixels of the detection frame
+                face_heights = [track.box[2] - track.box[0] for track in self.tracker.tracks if not track.missed]
+                if self.capture.observe(face_heights):
+                    capture = self.capture_changed()
+                if frame is not None:
+                    # Encoded once, shared by every subscriber of this camera
+                    await self.channel_layer.group_send(
+                        self.annotated_group, {'type': 'annotated.frame', 'jpeg': frame})
+        else:
+            self.count('skipped')
+        persons = self.persons
+        image = None
+
+        if persons:
+            image = "media/simu/house_imageON.jpg"
+            # if self.TRIGGER else "media/simu/house_imageOFF.jpg"
+
+        response = {
+            "image": image,
+            "faces": len(persons),
+            "persons": persons,
+            "stats": dict(self.stats, faces=self.tracker.faces, faces_encoded=self.tracker.encoded,
+                          write_queue=writer.depth, camera_fps=round(self.throughput.fps, 2),
+                          queue_wait_ms=round(self.recognizer.last_wait * 1e3, 1)),
+        }
+        if capture is not None:
+            response['capture'] = capture
+        return response
+
+
+class RoomStateConsumer(AsyncWebsocketConsumer):
+    """
+    Pushes the state of the rooms: {"type": "snapshot", "rooms": [...]} with every
+    room and its owners on connect, then {"type": "delta", "rooms": [...]} with the
+    id, light_status and occupant_count of the rooms that changed.
+    Deltas carry the new values, not differences, so applying one twice is harmless.
+    """
+
     async def connect(self):
+        if not self.scope['user'].is_authenticated:
+            await self.close()
+            return
+        # Join before reading the snapshot so no change falls between the two
+        await self.channel_layer.group_add(ROOMS_GROUP, self.channel_name)
         await self.accept()
-        print("Exist WebSocket connection accepted")
+        rooms = await database_sync_to_async(rooms_snapshot)()
+        await self.send(text_data=json.dumps({'type': 'snapshot', 'rooms': rooms}))
 
     async def disconnect(self, close_code):
-        print("Exist WebSocket connection closed:", close_code)
+        await self.channel_layer.group_discard(ROOMS_GROUP, self.channel_name)
 
-    async def receive(self, text_data=None, bytes_data=None):
-        if bytes_data:
-            # Decode the incoming frame into an image
-            nparr = np.frombuffer(bytes_data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-            # Process the frame
-            frame, persons = await recognize_person_channel(frame, 'exit')
-            image = None
-            
-            if persons:
-                image = "media/simu/house_imageON.jpg"
-                # if self.TRIGGER else "media/simu/house_imageOFF.jpg"
-
-            response = {
-                "image": image,
-                "faces": len(persons),
-                "persons": persons
-            }
-
-            await self.send(text_data=json.dumps(response))
\ No newline at end of file
+    async def rooms_delta(self, event):
+        await self.send(text_data=json.dumps({'type': 'delta', 'rooms': event['rooms']}))
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:00
+
+import json
+
+import numpy as np
+from django.db import migrations, models
+
+
+def text_to_binary(apps, schema_editor):
+    Person = apps.get_model("facerecognition", "Person")
+    for person in Person.objects.exclude(face_encoding="").only("pk", "face_encoding"):
+        try:
+            encoding = np.asarray(json.loads(person.face_encoding), dtype=np.float32)
+        except (ValueError, TypeError):
+            continue
+        if encoding.shape != (128,):
+            continue
+        Person.objects.filter(pk=person.pk).update(face_encoding_bin=encoding.tobytes())
+
+
+def binary_to_text(apps, schema_editor):
+    Person = apps.get_model("facerecognition", "Person")
+    for person in Person.objects.exclude(face_encoding_bin=None).only("pk", "face_encoding_bin"):
+        encoding = np.frombuffer(person.face_encoding_bin, dtype=np.float32)
+        Person.objects.filter(pk=person.pk).update(face_encoding=str(encoding.tolist()))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("facerecognition", "0007_alter_person_room"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="person",
+            name="face_encoding_bin",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(text_to_binary, binary_to_text),
+        migrations.RemoveField(
+            model_name="person",
+            name="face_encoding",
+        ),
+        migrations.RenameField(
+            model_name="person",
+            old_name="face_encoding_bin",
+            new_name="face_encoding",
+        ),
+    ]
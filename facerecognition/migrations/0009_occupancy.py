@@ -0,0 +1,51 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:08
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+
+
+def compute_occupancy(apps, schema_editor):
+    Person = apps.get_model('facerecognition', 'Person')
+    Room = apps.get_model('facerecognition', 'Room')
+    House = apps.get_model('facerecognition', 'House')
+    Activity = apps.get_model('facerecognition', 'Activity')
+
+    # in_house was never maintained before, derive it from each person's latest activity
+    latest_action = Activity.objects.filter(person=OuterRef('pk')).order_by('-date', '-pk').values('action')[:1]
+    inside = list(Person.objects.annotate(latest_action=Subquery(latest_action))
+                  .filter(latest_action='enter').values_list('pk', flat=True))
+    Person.objects.filter(pk__in=inside).update(in_house=True)
+    Person.objects.exclude(pk__in=inside).update(in_house=False)
+
+    counts = Person.objects.filter(in_house=True, room__isnull=False).values('room').annotate(n=Count('pk'))
+    for row in counts:
+        Room.objects.filter(pk=row['room']).update(occupant_count=row['n'])
+    House.objects.update_or_create(pk=1, defaults={'occupant_count': Person.objects.filter(in_house=True).count()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facerecognition', '0008_person_face_encoding_binary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='House',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('occupant_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='occupant_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='person',
+            name='in_house',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(compute_occupancy, migrations.RunPython.noop),
+    ]
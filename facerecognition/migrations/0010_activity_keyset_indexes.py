@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facerecognition', '0009_occupancy'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['-date', '-id'], name='activity_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['person', '-date', '-id'], name='activity_person_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['room', '-date', '-id'], name='activity_room_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['action', '-date', '-id'], name='activity_action_date_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_door_cameras(apps, schema_editor):
+    # The two cameras ws/video/ and ws/exit/ served before the registry
+    Camera = apps.get_model('facerecognition', 'Camera')
+    Camera.objects.create(name='Enter', direction='enter')
+    Camera.objects.create(name='Exit', direction='exit')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facerecognition', '0010_activity_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Camera',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('direction', models.CharField(choices=[('enter', 'Enter'), ('exit', 'Exit')], default='enter', max_length=10)),
+                ('roi', models.JSONField(blank=True, null=True)),
+                ('frame_budget', models.FloatField(default=2.0)),
+                ('room', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='cameras', to='facerecognition.room')),
+            ],
+        ),
+        migrations.RunPython(create_door_cameras, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facerecognition', '0011_camera'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camera',
+            name='weight',
+            field=models.FloatField(default=1.0),
+        ),
+    ]
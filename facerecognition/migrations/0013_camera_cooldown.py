@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facerecognition', '0012_camera_weight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camera',
+            name='cooldown',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
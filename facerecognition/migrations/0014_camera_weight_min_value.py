@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:06
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facerecognition', '0013_camera_cooldown'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='camera',
+            name='weight',
+            field=models.FloatField(default=1.0, validators=[django.core.validators.MinValueValidator(0.01)]),
+        ),
+    ]
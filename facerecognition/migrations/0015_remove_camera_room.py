@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:25
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('facerecognition', '0014_camera_weight_min_value'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='camera',
+            name='room',
+        ),
+    ]
@@ -1,7 +1,13 @@
-from django.db import models
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
+from django.db.models import Case, Exists, F, IntegerField, Value, When
 from django.conf import settings
+from collections import Counter
+from datetime import timedelta
 import os
+import numpy as np
 from django.utils import timezone
+from .room_state import rooms_changed
 
 def define_image_path(instance, filename):
     return os.path.join('faces', f'{instance.pk}.jpg')
@@ -10,43 +16,176 @@ def delete_file(file_field):
     if file_field and os.path.isfile(file_field.path):
         os.remove(file_field.path)
 
+class TrackChangesModel(models.Model):
+    """
+    Keeps a snapshot of the field values loaded from the database,
+    so save() can tell what changed without querying the old row
+    """
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def _current_value(self, attname):
+        field = self._meta.get_field(attname[:-3] if attname.endswith('_id') else attname)
+        return field.get_prep_value(field.value_from_object(self))
+
+    def has_changed(self, attname):
+        """
+        True for new instances, fields that were not loaded and fields whose value changed
+        """
+        loaded = getattr(self, '_loaded_values', None)
+        if self._state.adding or loaded is None or attname not in loaded:
+            return True
+        return loaded[attname] != self._current_value(attname)
+
+    def loaded_file(self, name):
+        """
+        The file the field pointed to when the instance was loaded, or None if unknown
+        """
+        loaded = getattr(self, '_loaded_values', None)
+        if self._state.adding or loaded is None or name not in loaded:
+            return None
+        field = self._meta.get_field(name)
+        return field.attr_class(self, field, loaded[name])
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            # Only the saved fields now match the row, the others keep what was loaded
+            # so a later save still sees them as changed
+            if getattr(self, '_loaded_values', None) is None:
+                self._loaded_values = {}
+            for field in self._meta.concrete_fields:
+                if field.name in update_fields or field.attname in update_fields:
+                    self._loaded_values[field.attname] = self._current_value(field.attname)
+            return
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {
+            field.attname: self._current_value(field.attname)
+            for field in self._meta.concrete_fields
+            if field.attname not in deferred
+        }
+
 class Room(models.Model):
     name = models.CharField(max_length=100)
     light_status = models.BooleanField(default=False)
+    # Persons in the house whose room this is, kept up to date by apply_occupancy_changes
+    occupant_count = models.IntegerField(default=0)
 
     def __str__(self):
         return self.name
 
-class Person(models.Model):
+class Camera(models.Model):
+    """
+    A camera at a door of the house, streaming frames to ws/camera/<id>/
+    """
+    DIRECTIONS = [('enter', 'Enter'), ('exit', 'Exit')]
+    name = models.CharField(max_length=100)
+    # Whether the persons it recognizes are entering or leaving
+    direction = models.CharField(max_length=10, choices=DIRECTIONS, default='enter')
+    # [x, y, width, height] as fractions of the frame where faces are looked for, the whole frame when empty
+    roi = models.JSONField(blank=True, null=True)
+    # Frames per second that go through recognition at most, the frames in between are dropped
+    frame_budget = models.FloatField(default=2.0)
+    # Share of the recognition workers when they are saturated, relative to the other cameras
+    weight = models.FloatField(default=1.0, validators=[MinValueValidator(0.01)])
+    # Seconds within which a person seen again doing the same action is not recorded again,
+    # FACE_RECOGNITION_COOLDOWN_SECONDS when empty
+    cooldown = models.PositiveIntegerField(blank=True, null=True)
+
+    def get_roi(self):
+        return tuple(self.roi) if self.roi else None
+
+    def get_cooldown(self):
+        seconds = self.cooldown if self.cooldown is not None else settings.FACE_RECOGNITION_COOLDOWN_SECONDS
+        return timedelta(seconds=seconds)
+
+    def __str__(self):
+        return f"{self.name} ({self.direction})"
+
+class House(models.Model):
+    """
+    Materialized occupancy of the whole house, a single row
+    """
+    occupant_count = models.IntegerField(default=0)
+
+    @classmethod
+    def load(cls):
+        return cls.objects.get_or_create(pk=1)[0]
+
+class Person(TrackChangesModel):
     name = models.CharField(max_length=100)
     about = models.TextField(blank=True)
-    face_encoding = models.TextField(blank=True)
+    # float32 (128,) face encoding stored as 512 raw bytes
+    face_encoding = models.BinaryField(blank=True, null=True)
     image = models.ImageField(upload_to=define_image_path, blank=True, null=True, default='person_placeholder.jpg')
     enter_date = models.TimeField(blank=True, null=True)
     exit_date = models.TimeField(blank=True, null=True)
     room = models.ForeignKey(Room, on_delete=models.SET_NULL, blank=True, null=True, related_name='owner')
-    in_house = models.BooleanField(default=True)
+    # Set by the enter and exit cameras, persons are out until first seen entering
+    in_house = models.BooleanField(default=False, db_index=True)
     def is_in_house(self):
         return self.room is not None
 
+    def set_face_encoding(self, encoding):
+        self.face_encoding = np.asarray(encoding, dtype=np.float32).tobytes()
+
+    def get_face_encoding(self):
+        if not self.face_encoding:
+            return None
+        return np.frombuffer(self.face_encoding, dtype=np.float32)
+
     def save(self, *args, **kwargs):
-        try:
-            old_image = Person.objects.get(pk=self.pk).image
+        if self.pk and self.has_changed('image'):
+            old_image = self.loaded_file('image')
+            if old_image is None and not self._state.adding:
+                # Instance not loaded from the database, fall back to reading the old row
+                old_image = Person.objects.filter(pk=self.pk).values_list('image', flat=True).first()
+                old_image = self.image.field.attr_class(self, self.image.field, old_image) if old_image else None
             if old_image and old_image != self.image and old_image.name != 'person_placeholder.jpg':
                 delete_file(old_image)
-        except Person.DoesNotExist:
-            pass
-        super(Person, self).save(*args, **kwargs)
+
+        update_fields = kwargs.get('update_fields')
+        occupancy_saved = update_fields is None or {'in_house', 'room', 'room_id'} & set(update_fields)
+        old = new = (self.in_house, self.room_id)
+        if occupancy_saved and (self.has_changed('in_house') or self.has_changed('room_id')):
+            loaded = getattr(self, '_loaded_values', None) or {}
+            if self._state.adding:
+                old = (False, None)
+            elif 'in_house' in loaded and 'room_id' in loaded:
+                old = (loaded['in_house'], loaded['room_id'])
+            else:
+                old = Person.objects.filter(pk=self.pk).values_list('in_house', 'room_id').first() or (False, None)
+            if update_fields is not None:
+                # A field left out of update_fields keeps its stored value
+                new = (self.in_house if 'in_house' in update_fields else old[0],
+                       self.room_id if {'room', 'room_id'} & set(update_fields) else old[1])
+        # Persons out of the house do not count, wherever their room is
+        if (old[0] and old) == (new[0] and new):
+            super(Person, self).save(*args, **kwargs)
+            return
+        with transaction.atomic():
+            super(Person, self).save(*args, **kwargs)
+            apply_occupancy_changes([(old, new)])
 
     def delete(self, *args, **kwargs):
         if self.image.name != 'person_placeholder.jpg':
             delete_file(self.image)
-        super().delete(*args, **kwargs)
+        with transaction.atomic():
+            if self.in_house:
+                apply_occupancy_changes([((True, self.room_id), (False, None))])
+            super().delete(*args, **kwargs)
 
     def __str__(self):
         return self.name
 
-class Activity(models.Model):
+class Activity(TrackChangesModel):
     person = models.ForeignKey(Person, on_delete=models.CASCADE)
     room = models.ForeignKey(Room, on_delete=models.SET_NULL, blank=True, null=True)
     date = models.DateField(default=timezone.now)
@@ -57,20 +196,30 @@ class Activity(models.Model):
     actual_exit_date = models.DateTimeField(blank=True, null=True)
     image = models.ImageField(upload_to='activities', blank=True, null=True)
 
-    def save(self, *args, **kwargs):
-        if self.room:
-            self.room.light_status = True if self.enter_date else False
-            self.room.save()
+    class Meta:
+        # Keyset pagination walks (date, id) newest first, alone or after an equality filter
+        indexes = [
+            models.Index(fields=['-date', '-id'], name='activity_date_idx'),
+            models.Index(fields=['person', '-date', '-id'], name='activity_person_date_idx'),
+            models.Index(fields=['room', '-date', '-id'], name='activity_room_date_idx'),
+            models.Index(fields=['action', '-date', '-id'], name='activity_action_date_idx'),
+        ]
 
-        update_house_status()
+    def save(self, *args, **kwargs):
+        # The room light only follows new activities or a change of room or enter date
+        if self.has_changed('room_id') or self.has_changed('enter_date'):
+            light_status = True if self.enter_date else False
+            if self.room and self.room.light_status != light_status:
+                self.room.light_status = light_status
+                self.room.save(update_fields=['light_status'])
 
-        if self.pk:
-            try:
-                old_image = Activity.objects.get(pk=self.pk).image
-                if old_image and old_image != self.image:
-                    delete_file(old_image)
-            except Activity.DoesNotExist:
-                pass
+        if self.pk and not self._state.adding and self.has_changed('image'):
+            old_image = self.loaded_file('image')
+            if old_image is None:
+                old_image = Activity.objects.filter(pk=self.pk).values_list('image', flat=True).first()
+                old_image = self.image.field.attr_class(self, self.image.field, old_image) if old_image else None
+            if old_image and old_image != self.image:
+                delete_file(old_image)
 
         super(Activity, self).save(*args, **kwargs)
 
@@ -82,7 +231,64 @@ class Activity(models.Model):
     def __str__(self):
         return f"{self.person.name} activity in {self.room.name if self.room else 'N/A'}"
 
-def update_house_status():
-    is_house_empty = not Person.objects.filter(room__isnull=False).exists()
-    if is_house_empty:
-        Room.objects.update(light_status=False)
\ No newline at end of file
+def is_house_empty():
+    return not House.objects.filter(pk=1, occupant_count__gt=0).exists()
+
+def who_is_home():
+    return Person.objects.filter(in_house=True)
+
+def switch_off_lights(if_house_empty=False):
+    """
+    Switch every light off, only once nobody is left in the house when if_house_empty is True
+    """
+    rooms = Room.objects.filter(light_status=True)
+    if if_house_empty:
+        rooms = rooms.filter(Exists(House.objects.filter(pk=1, occupant_count__lte=0)))
+    room_ids = list(rooms.values_list('pk', flat=True))
+    if room_ids:
+        Room.objects.filter(pk__in=room_ids).update(light_status=False)
+        rooms_changed(room_ids)
+
+def apply_occupancy_changes(changes, lights=False):
+    """
+    Update the materialized occupancy counts, in the caller's transaction.
+    :param changes: list of ((old in_house, old room id), (new in_house, new room id)) of persons
+    :param lights: also switch the lights of the rooms that become occupied or empty,
+                   and every light when the house becomes empty
+    """
+    room_deltas = Counter()
+    house_delta = 0
+    for (old_in_house, old_room), (new_in_house, new_room) in changes:
+        if old_in_house:
+            house_delta -= 1
+            if old_room is not None:
+                room_deltas[old_room] -= 1
+        if new_in_house:
+            house_delta += 1
+            if new_room is not None:
+                room_deltas[new_room] += 1
+    room_deltas = {room_id: delta for room_id, delta in room_deltas.items() if delta}
+
+    if room_deltas:
+        # One UPDATE for every room, the conditions read the counts from before it
+        values = {'occupant_count': F('occupant_count') + Case(
+            *[When(pk=room_id, then=Value(delta)) for room_id, delta in room_deltas.items()],
+            output_field=IntegerField(),
+        )}
+        if lights:
+            # Only rooms whose state flips are switched, the others keep their light
+            values['light_status'] = Case(
+                *[When(pk=room_id, occupant_count__lte=0, occupant_count__gt=-delta, then=Value(True))
+                  for room_id, delta in room_deltas.items() if delta > 0],
+                *[When(pk=room_id, occupant_count__gt=0, occupant_count__lte=-delta, then=Value(False))
+                  for room_id, delta in room_deltas.items() if delta < 0],
+                default=F('light_status'),
+            )
+        Room.objects.filter(pk__in=room_deltas).update(**values)
+        rooms_changed(room_deltas)
+
+    if house_delta:
+        # The single row is created by migration 0009
+        House.objects.filter(pk=1).update(occupant_count=F('occupant_count') + house_delta)
+        if lights and house_delta < 0:
+            switch_off_lights(if_house_empty=True)
\ No newline at end of file
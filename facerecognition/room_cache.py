@@ -0,0 +1,54 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+ALL_ROOMS = 'rooms:all'
+
+
+def room_key(room_id):
+    return f'rooms:{room_id}'
+
+
+def current_version(key):
+    # Entries are stored under a version that invalidation bumps, so a payload built from rows read
+    # before a change can only land under the old version, never be served after the change
+    version = cache.get(f'{key}:version')
+    if version is None:
+        cache.add(f'{key}:version', time.time_ns(), timeout=None)
+        version = cache.get(f'{key}:version')
+    return version
+
+
+def cached_payload(key, build):
+    """
+    this function returns (etag, data) of a room payload, building it only when it is not cached
+    :param build: function returning the serialized data, only called on a miss
+    """
+    versioned_key = f'{key}:{current_version(key)}'
+    entry = cache.get(versioned_key)
+    if entry is None:
+        data = build()
+        etag = '"%s"' % hashlib.sha1(JSONRenderer().render(data)).hexdigest()
+        entry = (etag, data)
+        cache.set(versioned_key, entry, timeout=60 * 60 * 24)
+    return entry
+
+
+def invalidate_rooms(room_ids):
+    """
+    this function drops the cached payloads of the rooms and of the room list once the current transaction commits
+    """
+    keys = [ALL_ROOMS] + [room_key(room_id) for room_id in set(room_ids) if room_id is not None]
+    transaction.on_commit(lambda: bump_versions(keys))
+
+
+def bump_versions(keys):
+    for key in keys:
+        try:
+            cache.incr(f'{key}:version')
+        except ValueError:
+            # Never read yet, nothing cached under it
+            pass
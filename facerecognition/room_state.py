@@ -0,0 +1,45 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from .room_cache import invalidate_rooms
+
+# Channel layer group of the clients following the rooms
+ROOMS_GROUP = 'rooms'
+
+# What a delta carries for each changed room
+ROOM_STATE_FIELDS = ('id', 'light_status', 'occupant_count')
+
+
+def rooms_snapshot():
+    """
+    this function returns the state of every room with its owners, sent to a client when it connects
+    """
+    from .models import Person, Room
+
+    rooms = {room['id']: dict(room, owner=[]) for room in Room.objects.values('name', *ROOM_STATE_FIELDS)}
+    for owner in Person.objects.filter(room__isnull=False).values('id', 'name', 'room'):
+        rooms[owner.pop('room')]['owner'].append(owner)
+    return list(rooms.values())
+
+
+def rooms_changed(room_ids):
+    """
+    this function pushes the new state of the rooms to the clients once the current transaction commits,
+    it is called by every write of Room.light_status or Room.occupant_count, including the update() ones
+    """
+    room_ids = set(room_ids)
+    if room_ids:
+        invalidate_rooms(room_ids)
+        transaction.on_commit(lambda: send_room_deltas(room_ids))
+
+
+def send_room_deltas(room_ids):
+    from .models import Room
+
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    rooms = list(Room.objects.filter(pk__in=room_ids).values(*ROOM_STATE_FIELDS))
+    if rooms:
+        async_to_sync(channel_layer.group_send)(ROOMS_GROUP, {'type': 'rooms.delta', 'rooms': rooms})
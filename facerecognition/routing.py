@@ -4,6 +4,9 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
-    path('ws/video/', consumers.EnterCameraVideoStreamConsumer.as_asgi()),  # WebSocket endpoint
-    path('ws/exit/', consumers.ExitCameraVideoStreamConsumer.as_asgi()),  # WebSocket endpoint
+    path('ws/camera/<int:camera_id>/', consumers.CameraVideoStreamConsumer.as_asgi()),  # One endpoint per registered camera
+    # Endpoints of the first enter and exit cameras, from before the camera registry
+    path('ws/video/', consumers.CameraVideoStreamConsumer.as_asgi(), {'direction': 'enter'}),
+    path('ws/exit/', consumers.CameraVideoStreamConsumer.as_asgi(), {'direction': 'exit'}),
+    path('ws/rooms/', consumers.RoomStateConsumer.as_asgi()),  # Room state pushed to dashboards
 ]
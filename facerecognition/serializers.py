@@ -1,7 +1,7 @@
 from django.contrib import admin
 from rest_framework import serializers
 from django.utils import timezone
-from .models import Activity, Person ,Room
+from .models import Activity, Person ,Room, Camera
 
 class PersonSerializer(serializers.ModelSerializer):
     class Meta:
@@ -16,6 +16,12 @@ class RoomSerializer(serializers.ModelSerializer):
     
 
 
+class CameraSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Camera
+        fields = '__all__'
+
+
 class ActivitySerializer(serializers.ModelSerializer):
     person = PersonSerializer()  # Nested serializer to include person details
     
@@ -68,4 +74,82 @@ class ActivitySerializer(serializers.ModelSerializer):
         request = self.context.get('request')
         if obj.image:
             return request.build_absolute_uri(obj.image.url) if request else obj.image.url
-        return None
\ No newline at end of file
+        return None
+
+# Bulk read-only path: the same output as ActivitySerializer(activities, many=True).data
+# without a request, built from .values() rows instead of model instances and DRF fields
+ACTIVITY_VALUES = (
+    'id', 'date', 'enter_date', 'exit_date', 'actual_enter_date', 'actual_exit_date', 'image', 'action',
+    'person__id', 'person__name', 'person__about', 'person__image', 'person__enter_date',
+    'person__exit_date', 'person__room', 'person__in_house',
+)
+
+
+class ActivityFormatter:
+    """
+    Formats the values of many rows, each distinct minute is formatted once:
+    the output only has minute precision and camera events come in bursts
+    """
+
+    def __init__(self):
+        self.timezone = timezone.get_current_timezone()
+        self.times = {}
+        self.datetimes = {}
+        self.image_url = Activity._meta.get_field('image').storage.url
+        self.person_image_url = Person._meta.get_field('image').storage.url
+
+    def time(self, value):
+        if not value:
+            return None
+        key = (value.hour, value.minute)
+        formatted = self.times.get(key)
+        if formatted is None:
+            formatted = self.times[key] = value.strftime('%I:%M %p')
+        return formatted
+
+    def datetime(self, value):
+        if not value:
+            return None
+        key = value.replace(second=0, microsecond=0)
+        formatted = self.datetimes.get(key)
+        if formatted is None:
+            formatted = self.datetimes[key] = value.astimezone(self.timezone).strftime('%Y-%m-%d %I:%M %p')
+        return formatted
+
+
+def activity_values(activities):
+    return activities.values(*ACTIVITY_VALUES)
+
+
+def serialize_activity_values(rows):
+    """
+    this function serializes rows of activity_values() like ActivitySerializer
+    :param rows: iterable of dicts, e.g. activity_values(queryset)
+    :return: list of dicts, rendered to the same bytes as the serializer data
+    """
+    formatter = ActivityFormatter()
+    data = []
+    for row in rows:
+        image = row['image']
+        image_url = formatter.image_url(image) if image else None
+        person_image = row['person__image']
+        data.append({
+            'person': {
+                'id': row['person__id'],
+                'name': row['person__name'],
+                'about': row['person__about'],
+                'image': formatter.person_image_url(person_image) if person_image else None,
+                'enter_date': row['person__enter_date'].isoformat() if row['person__enter_date'] is not None else None,
+                'exit_date': row['person__exit_date'].isoformat() if row['person__exit_date'] is not None else None,
+                'room': row['person__room'],
+                'in_house': row['person__in_house'],
+            },
+            'enter_date': formatter.time(row['enter_date']),
+            'exit_date': formatter.time(row['exit_date']),
+            'actual_enter_date': formatter.datetime(row['actual_enter_date']),
+            'actual_exit_date': formatter.datetime(row['actual_exit_date']),
+            'image': image_url,
+            'image_url': image_url,
+            'action': row['action'],
+        })
+    return data
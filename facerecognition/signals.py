@@ -0,0 +1,71 @@
+import weakref
+
+import numpy as np
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Person, Room
+from .room_cache import invalidate_rooms
+from .room_state import rooms_changed
+
+# Recognizers serving live camera streams, kept in sync with the Person table
+live_recognizers = weakref.WeakSet()
+
+
+def register_recognizer(sfr):
+    """
+    Keep the gallery of sfr up to date when people are added, updated or deleted
+    """
+    live_recognizers.add(sfr)
+    return sfr
+
+
+@receiver(post_save, sender=Person)
+def update_recognizers_on_save(sender, instance, update_fields=None, **kwargs):
+    if not live_recognizers:
+        return
+    # Nothing to do when the encoding was not part of this save
+    if update_fields is not None and 'face_encoding' not in update_fields:
+        return
+    if 'face_encoding' in instance.get_deferred_fields():
+        return
+    encoding = instance.get_face_encoding()
+    if encoding is None or len(encoding) != 128:
+        return
+    name = str(instance.pk)
+    for sfr in list(live_recognizers):
+        gallery = sfr.snapshot()
+        row = gallery.index.get(name)
+        # A save that leaves the encoding as it is must not start a new gallery generation,
+        # it would republish the gallery to the workers and reset every camera's tracker
+        if row is not None and np.array_equal(gallery.encodings[row], encoding):
+            continue
+        sfr.add_face(name, encoding)
+
+
+@receiver(post_delete, sender=Person)
+def update_recognizers_on_delete(sender, instance, **kwargs):
+    for sfr in list(live_recognizers):
+        sfr.remove_face(str(instance.pk))
+
+
+@receiver(post_save, sender=Room)
+def push_room_on_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'light_status', 'occupant_count'} & set(update_fields):
+        invalidate_rooms([instance.pk])
+        return
+    rooms_changed([instance.pk])
+
+
+@receiver(post_delete, sender=Room)
+def invalidate_room_on_delete(sender, instance, **kwargs):
+    invalidate_rooms([instance.pk])
+
+
+@receiver(post_save, sender=Person)
+@receiver(post_delete, sender=Person)
+def invalidate_owner_rooms(sender, instance, **kwargs):
+    # The person is listed as an owner of their room, and of the previous one until this save
+    loaded = getattr(instance, '_loaded_values', None) or {}
+    invalidate_rooms([instance.room_id, loaded.get('room_id')])
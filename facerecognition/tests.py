@@ -1,3 +1,1263 @@
-from django.test import TestCase
+import asyncio
+import atexit
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import face_recognition
+import numpy as np
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from openpyxl import load_workbook
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .models import Person, Activity, Room, House, Camera, is_house_empty, who_is_home
+from .ai_models.ann_index import IVFIndex, sq_distances
+from .ai_models.capture import CaptureSize
+from .ai_models import executor as recognition_executor
+from .ai_models.encoding_store import EncodingStore, content_hash
+from .ai_models.ingest import crop_roi, decode_frame
+from .ai_models.motion import MotionGate
+from .ai_models.presence import PresenceTracker
+from .ai_models.recognize import annotate_jpeg, record_activities, load_faces_from_db, load_presence_from_db
+from .ai_models.tracker import FaceTracker
+from .ai_models.scheduler import FairScheduler, FrameExpired
+from .ai_models.simple_facerec import SimpleFacerec
+from .camera_stats import camera_throughput
+from .room_state import ROOMS_GROUP, rooms_snapshot
+from .signals import live_recognizers, register_recognizer
+from .serializers import ActivitySerializer, activity_values, serialize_activity_values
+from .write_behind import ActivityWriteBehind, write_activities
+
+
+class PersonSaveTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Room 1')
+        self.person = Person.objects.create(name='Sara', room=self.room)
+
+    def test_create_is_a_single_insert(self):
+        with self.assertNumQueries(1):
+            Person.objects.create(name='Omar', room=self.room)
+
+    def test_save_without_image_change_is_a_single_update(self):
+        person = Person.objects.get(pk=self.person.pk)
+        person.about = 'updated'
+        with self.assertNumQueries(1):
+            person.save()
+
+    def test_repeated_saves_stay_single_updates(self):
+        person = Person.objects.get(pk=self.person.pk)
+        person.save()
+        person.enter_date = '08:30'
+        with self.assertNumQueries(1):
+            person.save()
+
+    def test_fields_left_out_of_update_fields_stay_changed(self):
+        person = Person.objects.get(pk=self.person.pk)
+        person.in_house = True
+        person.save(update_fields=['name'])
+        self.assertFalse(Person.objects.get(pk=person.pk).in_house)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.occupant_count, 0)
+        person.save()
+        self.room.refresh_from_db()
+        self.assertTrue(Person.objects.get(pk=person.pk).in_house)
+        self.assertEqual(self.room.occupant_count, 1)
+        self.assertEqual(House.load().occupant_count, 1)
+
+    def test_occupancy_follows_only_the_saved_fields(self):
+        other = Room.objects.create(name='Room 2')
+        person = Person.objects.get(pk=self.person.pk)
+        person.in_house = True
+        person.room = other
+        person.save(update_fields=['in_house'])
+        self.room.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.room.occupant_count, other.occupant_count), (1, 0))
+        person.save()
+        self.room.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.room.occupant_count, other.occupant_count), (0, 1))
+
+    def test_image_change_deletes_the_old_file(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with override_settings(MEDIA_ROOT=media_root):
+            person = Person.objects.get(pk=self.person.pk)
+            person.image = SimpleUploadedFile('a.jpg', b'first')
+            person.save()
+            person = Person.objects.get(pk=self.person.pk)
+            person.image = SimpleUploadedFile('b.jpg', b'second')
+            person.save()
+            directories, files = person.image.storage.listdir('faces')
+            self.assertEqual(files, [f'{person.pk}.jpg'])
+            with person.image.open('rb') as f:
+                self.assertEqual(f.read(), b'second')
+
+
+class ActivitySaveTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Room 1')
+        self.person = Person.objects.create(name='Sara', room=self.room)
+
+    def test_new_activity_turns_the_room_light_on(self):
+        Activity.objects.create(person=self.person, room=self.room, enter_date='08:00', action='enter')
+        self.room.refresh_from_db()
+        self.assertTrue(self.room.light_status)
+
+    def test_save_without_room_or_image_change_is_a_single_update(self):
+        Activity.objects.create(person=self.person, room=self.room, enter_date='08:00', action='enter')
+        activity = Activity.objects.get()
+        activity.action = 'exit'
+        with self.assertNumQueries(1):
+            activity.save()
+
+    def test_room_change_updates_the_new_room(self):
+        Activity.objects.create(person=self.person, room=self.room, enter_date='08:00', action='enter')
+        other = Room.objects.create(name='Room 2')
+        activity = Activity.objects.get()
+        activity.room = other
+        activity.save()
+        other.refresh_from_db()
+        self.assertTrue(other.light_status)
+
+
+class RecordActivitiesTests(TestCase):
+    def setUp(self):
+        rooms = [Room.objects.create(name=f'Room {i}') for i in range(3)]
+        self.people = [Person.objects.create(name=f'Person {i}', room=rooms[i % 3]) for i in range(6)]
+
+    def assertFrameQueries(self, faces):
+        person_ids = [person.pk for person in self.people[:faces]]
+        # persons, savepoint, person read, activity insert, person update, room update, house update, release
+        with self.assertNumQueries(8):
+            persons = record_activities(person_ids, 'enter')
+        self.assertEqual(len(persons), faces)
+        # exit: the lit rooms are read in case the house became empty, the emptied rooms are already off
+        with self.assertNumQueries(9):
+            record_activities(person_ids, 'exit')
+
+    def test_one_face_per_frame(self):
+        self.assertFrameQueries(1)
+
+    def test_queries_do_not_grow_with_the_faces(self):
+        self.assertFrameQueries(6)
+
+
+class OccupancyTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Room 1')
+        self.person = Person.objects.create(name='Sara', room=self.room)
+
+    def event(self, action):
+        return {'person': self.person.pk, 'room': self.room.pk, 'action': action,
+                'time': '2026-01-01T08:00:00', 'enter_date': '08:00:00', 'exit_date': None}
+
+    def test_enter_and_exit_flip_the_room_and_the_house(self):
+        write_activities([self.event('enter')])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.occupant_count, 1)
+        self.assertTrue(self.room.light_status)
+        self.assertFalse(is_house_empty())
+        self.assertEqual(list(who_is_home()), [self.person])
+
+        write_activities([self.event('exit')])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.occupant_count, 0)
+        self.assertFalse(self.room.light_status)
+        self.assertTrue(is_house_empty())
+
+    def test_repeated_enter_does_not_touch_the_rooms(self):
+        write_activities([self.event('enter')])
+        # savepoint, person read, activity insert, release: no person or room update
+        with self.assertNumQueries(4):
+            write_activities([self.event('enter')])
+
+    def test_one_batch_flips_only_the_rooms_that_change_state(self):
+        other = Room.objects.create(name='Room 2')
+        guest = Person.objects.create(name='Omar', room=other)
+        hall = Room.objects.create(name='Hall', light_status=True)
+        write_activities([self.event('enter'), dict(self.event('enter'), person=guest.pk, room=other.pk)])
+        rooms = Room.objects.in_bulk([self.room.pk, other.pk])
+        self.assertEqual([(room.occupant_count, room.light_status) for room in rooms.values()], [(1, True)] * 2)
+
+        write_activities([self.event('exit')])
+        rooms = Room.objects.in_bulk([self.room.pk, other.pk, hall.pk])
+        self.assertEqual((rooms[self.room.pk].occupant_count, rooms[self.room.pk].light_status), (0, False))
+        self.assertEqual((rooms[other.pk].occupant_count, rooms[other.pk].light_status), (1, True))
+        # Someone is still home: the lights of the empty rooms stay as they are
+        self.assertTrue(rooms[hall.pk].light_status)
+
+        write_activities([dict(self.event('exit'), person=guest.pk, room=other.pk)])
+        # The house is empty: every light goes off
+        self.assertFalse(Room.objects.filter(light_status=True).exists())
+        self.assertTrue(is_house_empty())
+
+    def test_person_save_and_delete_keep_the_counts(self):
+        other = Room.objects.create(name='Room 2')
+        person = Person.objects.get(pk=self.person.pk)
+        person.in_house = True
+        person.save()
+        person.room = other
+        person.save()
+        self.assertEqual(Room.objects.get(pk=self.room.pk).occupant_count, 0)
+        self.assertEqual(Room.objects.get(pk=other.pk).occupant_count, 1)
+        self.assertEqual(House.load().occupant_count, 1)
+        person.delete()
+        self.assertEqual(Room.objects.get(pk=other.pk).occupant_count, 0)
+        self.assertTrue(is_house_empty())
+
+
+class ActivityListTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Room 1')
+        self.people = [Person.objects.create(name=name, room=self.room) for name in ('Sara', 'Omar')]
+        for day in range(1, 6):
+            for person in self.people:
+                Activity.objects.create(person=person, room=self.room, date=f'2026-01-0{day}', action='enter')
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin'))
+
+    def test_pages_walk_every_activity_newest_first_in_constant_queries(self):
+        url = reverse('all-activities') + '?page_size=3'
+        seen = []
+        while url:
+            # activities joined with their person
+            with self.assertNumQueries(1):
+                response = self.client.get(url)
+            self.assertLessEqual(len(response.data['results']), 3)
+            seen.extend(response.data['results'])
+            url = response.data['next']
+        self.assertEqual(len(seen), 10)
+        self.assertEqual(seen[0]['person']['name'], 'Omar')
+
+    def test_filters(self):
+        response = self.client.get(reverse('all-activities'), {
+            'person': self.people[0].pk, 'date_from': '2026-01-02', 'date_to': '2026-01-03',
+        })
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(self.client.get(reverse('all-activities'), {'cursor': 'nope'}).status_code, 400)
+
+
+class ActivityExportTests(TestCase):
+    def setUp(self):
+        room = Room.objects.create(name='Room 1')
+        person = Person.objects.create(name='Sara', about='Owner', room=room)
+        for day in range(1, 4):
+            Activity.objects.create(person=person, room=room, date=f'2026-01-0{day}', action='enter')
+
+    def test_csv_export_streams_the_filtered_rows(self):
+        response = self.client.get(reverse('export_activities_to_excel'), {'format': 'csv', 'date_from': '2026-01-02'})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'Name,About,Enter Date,Exit Date,Actual Enter Date,Actual Exit Date,Action,Image')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('Sara,Owner,'))
+
+    def test_xlsx_export(self):
+        response = self.client.get(reverse('export_activities_to_excel'))
+        workbook = load_workbook(io.BytesIO(b''.join(response.streaming_content)), read_only=True)
+        rows = list(workbook['Activities'].values)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][:2], ('Sara', 'Owner'))
+
+
+class ActivityBulkSerializationTests(TestCase):
+    def test_same_bytes_as_the_serializer(self):
+        room = Room.objects.create(name='Room 1')
+        sara = Person.objects.create(name='Sara', about='Owner', room=room, enter_date='08:00', in_house=True)
+        omar = Person.objects.create(name='Omar', image='', room=None)
+        Activity.objects.create(person=sara, room=room, enter_date='08:05:31', action='enter',
+                                actual_enter_date='2026-03-01T23:59:59+00:00', image='activities/a.jpg')
+        Activity.objects.create(person=omar, exit_date='00:00', action='exit',
+                                actual_exit_date='2026-03-02T04:10:00+00:00')
+        Activity.objects.create(person=sara, action='')
+        activities = Activity.objects.order_by('id')
+        self.assertEqual(
+            JSONRenderer().render(serialize_activity_values(activity_values(activities))),
+            JSONRenderer().render(ActivitySerializer(activities, many=True).data),
+        )
+
+
+class RoomStateTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Room 1')
+        self.person = Person.objects.create(name='Sara', room=self.room)
+        self.channel_layer = get_channel_layer()
+        self.channel = async_to_sync(self.channel_layer.new_channel)()
+        async_to_sync(self.channel_layer.group_add)(ROOMS_GROUP, self.channel)
+        self.addCleanup(async_to_sync(self.channel_layer.group_discard), ROOMS_GROUP, self.channel)
+
+    def test_snapshot_has_the_owners(self):
+        self.assertEqual(rooms_snapshot(), [{
+            'id': self.room.pk, 'name': 'Room 1', 'light_status': False, 'occupant_count': 0,
+            'owner': [{'id': self.person.pk, 'name': 'Sara'}],
+        }])
+
+    def test_occupancy_change_is_pushed_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            write_activities([{'person': self.person.pk, 'room': self.room.pk, 'action': 'enter',
+                               'time': '2026-01-01T08:00:00', 'enter_date': '08:00:00', 'exit_date': None}])
+        message = async_to_sync(self.channel_layer.receive)(self.channel)
+        self.assertEqual(message, {'type': 'rooms.delta', 'rooms': [
+            {'id': self.room.pk, 'light_status': True, 'occupant_count': 1},
+        ]})
+
+
+class RoomCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.room = Room.objects.create(name='Room 1')
+        self.person = Person.objects.create(name='Sara', room=self.room)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin'))
+
+    def test_unchanged_poll_is_a_304_without_queries(self):
+        response = self.client.get(reverse('all-rooms'))
+        self.assertEqual(response.data[0]['owner'][0]['name'], 'Sara')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(reverse('all-rooms')).data, response.data)
+            response = self.client.get(reverse('all-rooms'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_person_and_room_saves_invalidate(self):
+        url = reverse('get-room', args=[self.room.pk])
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.person.name = 'Sara A.'
+            self.person.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['owner'][0]['name'], 'Sara A.')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.light_status = True
+            self.room.save()
+        self.assertTrue(self.client.get(url).data['light_status'])
+
+
+class CameraListTests(TestCase):
+    def test_lists_the_registered_cameras_with_their_throughput(self):
+        camera_throughput[1].count('processed')
+        self.addCleanup(camera_throughput.clear)
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username='admin'))
+        cameras = client.get(reverse('all-cameras')).data
+        # The enter and exit cameras of the migration
+        self.assertEqual([(camera['name'], camera['direction']) for camera in cameras], [('Enter', 'enter'), ('Exit', 'exit')])
+        self.assertEqual(cameras[0]['throughput']['processed'], 1)
+        self.assertIsNone(cameras[1]['throughput'])
+
+
+class ManualExecutor:
+    """
+    Recognition that only finishes when the test says so, one frame at a time
+    """
+    max_workers = 1
+
+    def __init__(self):
+        self.running = []
+
+    async def detect_known_faces(self, frame, tracker=None, roi=None, scale=None):
+        done = asyncio.get_running_loop().create_future()
+        self.running.append(done)
+        await done
+        return [], []
+
+
+class FairSchedulerTests(TestCase):
+    def run_cameras(self, weights, frames=80, service_time=0.01, **kwargs):
+        """
+        Every camera sends its next frame as soon as the previous one is answered, each frame takes
+        service_time on a clock that only moves when the test finishes a frame
+        :return: frames served, frames expired and the longest wait of a served frame
+        """
+        now = [0.0]
+        executor = ManualExecutor()
+        scheduler = FairScheduler(executor, clock=lambda: now[0], **kwargs)
+        served = dict.fromkeys(weights, 0)
+        expired = dict.fromkeys(weights, 0)
+        waits = []
+
+        async def camera(key):
+            recognizer = scheduler.camera(key, weights[key])
+            while True:
+                try:
+                    await recognizer.detect_known_faces(None)
+                except FrameExpired:
+                    expired[key] += 1
+                else:
+                    served[key] += 1
+                    waits.append(recognizer.last_wait)
+
+        async def settle():
+            for _ in range(20):
+                await asyncio.sleep(0)
+
+        async def run():
+            cameras = [asyncio.create_task(camera(key)) for key in weights]
+            for _ in range(frames):
+                await settle()
+                now[0] += service_time
+                executor.running.pop(0).set_result(None)
+            await settle()
+            for task in cameras:
+                task.cancel()
+            await asyncio.gather(*cameras, return_exceptions=True)
+
+        asyncio.run(run())
+        return served, expired, max(waits)
+
+    def test_workers_are_shared_by_weight(self):
+        served, expired, _ = self.run_cameras({'a': 2.0, 'b': 1.0, 'c': 1.0})
+        self.assertEqual(sum(served.values()), 80)
+        self.assertAlmostEqual(served['a'] / served['b'], 2, delta=0.15)
+        self.assertAlmostEqual(served['b'] / served['c'], 1, delta=0.1)
+        self.assertEqual(sum(expired.values()), 0)
+
+    def test_frames_past_the_deadline_expire(self):
+        served, expired, longest_wait = self.run_cameras({'a': 1.0, 'b': 1.0, 'c': 1.0}, deadline=0.025)
+        # The third camera in line would wait two service times for the worker
+        self.assertGreater(sum(expired.values()), 0)
+        self.assertLessEqual(longest_wait, 0.025)
+        # Every camera still gets served
+        self.assertTrue(all(served.values()))
+
+    def test_zero_weight_still_gets_served(self):
+        served, _, _ = self.run_cameras({'a': 1.0, 'b': 0.0}, frames=20)
+        self.assertEqual(sum(served.values()), 20)
+        self.assertGreater(served['b'], 0)
+
+
+class CaptureSizeTests(TestCase):
+    def test_captures_at_the_detection_size(self):
+        capture = CaptureSize(0.25, quality=0.8)
+        capture.set_native(640, 480)
+        self.assertEqual(capture.as_dict(), {'width': 160, 'height': 120, 'quality': 0.8})
+
+    def test_small_faces_raise_the_resolution_until_they_are_large_again(self):
+        capture = CaptureSize(0.25, min_face=60, patience=2)
+        self.assertFalse(capture.observe([30]))
+        capture.set_native(640, 480)
+        self.assertTrue(capture.observe([30]))
+        self.assertEqual(capture.as_dict()['width'], 320)
+        self.assertFalse(capture.observe([]))
+        self.assertFalse(capture.observe([120]))
+        self.assertFalse(capture.observe([200]))
+        self.assertTrue(capture.observe([200]))
+        self.assertEqual(capture.as_dict()['width'], 160)
+        # Never below frame_resizing
+        self.assertFalse(capture.observe([200]))
+        self.assertFalse(capture.observe([200]))
+
+
+class MatchFacesTests(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.known = rng.normal(scale=0.1, size=(50, 128))
+        self.sfr = SimpleFacerec()
+        self.sfr.set_known_faces(self.known, [f'person{i}' for i in range(50)])
+
+    def names(self, faces):
+        best_index, best_distance, _ = self.sfr.match_faces(faces)
+        return [self.sfr.known_face_names[index] if index >= 0 and distance <= self.sfr.tolerance else "Unknown"
+                for index, distance in zip(best_index, best_distance)]
+
+    def test_same_names_as_the_face_distance_loop(self):
+        rng = np.random.default_rng(1)
+        faces = np.vstack([self.known[:5] + rng.normal(scale=0.02, size=(5, 128)), rng.normal(size=(3, 128))])
+        expected = []
+        for face in faces:
+            distances = face_recognition.face_distance(self.known, face)
+            best = np.argmin(distances)
+            expected.append(f'person{best}' if distances[best] <= self.sfr.tolerance else "Unknown")
+        self.assertEqual(self.names(faces), expected)
+        self.assertEqual(expected[:5], [f'person{i}' for i in range(5)])
+        self.assertEqual(expected[5:], ["Unknown"] * 3)
+
+    def test_distances_match_face_distance(self):
+        face = self.known[3] + 0.01
+        _, best_distance, margin = self.sfr.match_faces([face])
+        distances = np.sort(face_recognition.face_distance(self.known, face))
+        self.assertAlmostEqual(float(best_distance[0]), distances[0], places=4)
+        self.assertAlmostEqual(float(margin[0]), distances[1] - distances[0], places=4)
+
+    def test_empty_gallery(self):
+        best_index, best_distance, margin = SimpleFacerec().match_faces(self.known[:2])
+        self.assertEqual(best_index.tolist(), [-1, -1])
+        self.assertTrue(np.isinf(best_distance).all() and np.isinf(margin).all())
+
+    def test_no_faces(self):
+        best_index, _, _ = self.sfr.match_faces(np.empty((0, 128)))
+        self.assertEqual(len(best_index), 0)
+
+    def test_one_entry_gallery_has_no_second_best(self):
+        sfr = SimpleFacerec()
+        sfr.set_known_faces(self.known[:1], ['only'])
+        best_index, best_distance, margin = sfr.match_faces(self.known[:1] + 0.01)
+        self.assertEqual(best_index.tolist(), [0])
+        self.assertAlmostEqual(float(best_distance[0]), 0.01 * np.sqrt(128), places=4)
+        self.assertTrue(np.isinf(margin[0]))
+
+    def test_tolerance_boundary(self):
+        direction = np.zeros(128)
+        direction[0] = 1
+        faces = [self.known[0] + 0.599 * direction, self.known[0] + 0.601 * direction]
+        best_index, best_distance, _ = self.sfr.match_faces(faces)
+        self.assertLessEqual(best_distance[0], 0.6)
+        self.assertGreater(best_distance[1], 0.6)
+        self.assertEqual(self.names(faces)[0], 'person0')
+        self.assertEqual(self.names(faces)[1], "Unknown")
+
+
+class EncodingStoreTests(TestCase):
+    def setUp(self):
+        self.images = tempfile.mkdtemp()
+        self.store_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.images)
+        self.addCleanup(shutil.rmtree, self.store_path)
+        for name, value in (('alice', 10), ('bob', 200), ('noface', 90)):
+            image = np.full((8, 8, 3), value, np.uint8)
+            cv2.imwrite(f'{self.images}/{name}.png', image)
+
+    def fake_encodings(self, rgb_img):
+        # One face per image, derived from its pixels, except for the noface image
+        value = int(rgb_img[0, 0, 0])
+        return [] if value == 90 else [np.full(128, value / 255)]
+
+    def load(self):
+        sfr = SimpleFacerec()
+        with mock.patch('face_recognition.face_encodings', side_effect=self.fake_encodings) as encode:
+            sfr.load_encoding_images(self.images, store_path=self.store_path)
+        return sfr, encode.call_count
+
+    def test_stored_encodings_are_reused(self):
+        sfr, encoded = self.load()
+        self.assertEqual(encoded, 3)
+        self.assertEqual(sorted(sfr.known_face_names), ['alice', 'bob'])
+        again, encoded = self.load()
+        # Including the image without a face
+        self.assertEqual(encoded, 0)
+        self.assertEqual(sorted(again.known_face_names), ['alice', 'bob'])
+        row = again.known_face_names.index('bob')
+        self.assertTrue(np.allclose(again.known_face_encodings[row], 200 / 255))
+
+    def test_store_is_rewritten_when_an_image_is_removed(self):
+        self.load()
+        self.assertEqual(len(EncodingStore(self.store_path)), 3)
+        with open(f'{self.images}/bob.png', 'rb') as f:
+            bob = content_hash(f.read())
+        os.remove(f'{self.images}/bob.png')
+        sfr, encoded = self.load()
+        self.assertEqual(encoded, 0)
+        self.assertEqual(sfr.known_face_names, ['alice'])
+        store = EncodingStore(self.store_path)
+        self.assertEqual(len(store), 2)
+        self.assertNotIn(bob, store)
+
+    def test_corrupt_store_is_rebuilt(self):
+        self.load()
+        with open(f'{self.store_path}/index.json', 'w') as f:
+            f.write('{not json')
+        self.assertEqual(len(EncodingStore(self.store_path)), 0)
+        sfr, encoded = self.load()
+        self.assertEqual(encoded, 3)
+        self.assertEqual(len(EncodingStore(self.store_path)), 3)
+
+    def test_inconsistent_store_is_rebuilt(self):
+        store = EncodingStore(self.store_path)
+        store.save({'a': np.zeros(128)})
+        with open(f'{self.store_path}/index.json', 'w') as f:
+            f.write('{"a": 0, "b": 5}')
+        self.assertEqual(len(EncodingStore(self.store_path)), 0)
+
+
+class GalleryTests(TestCase):
+    def test_add_and_remove_faces(self):
+        sfr = SimpleFacerec()
+        sfr.add_face('1', np.zeros(128))
+        sfr.add_face('2', np.ones(128))
+        self.assertEqual(sfr.known_face_names, ['1', '2'])
+        self.assertEqual(sfr.generation, 2)
+        # Replacing keeps the row
+        sfr.add_face('1', np.full(128, 0.5))
+        self.assertEqual(sfr.known_face_names, ['1', '2'])
+        self.assertTrue(np.allclose(sfr.known_face_encodings[0], 0.5))
+        self.assertTrue(sfr.remove_face('1'))
+        self.assertFalse(sfr.remove_face('1'))
+        self.assertEqual(sfr.known_face_names, ['2'])
+        self.assertEqual(sfr.snapshot().index, {'2': 0})
+
+    def test_snapshot_is_not_changed_by_updates(self):
+        sfr = SimpleFacerec()
+        sfr.add_face('1', np.zeros(128))
+        snapshot = sfr.snapshot()
+        sfr.add_face('1', np.ones(128))
+        sfr.remove_face('1')
+        self.assertEqual(snapshot.names, ('1',))
+        self.assertTrue(np.array_equal(snapshot.encodings[0], np.zeros(128)))
+        self.assertFalse(snapshot.encodings.flags.writeable)
+        self.assertEqual(snapshot.generation + 2, sfr.generation)
+
+
+class RecognizerSignalTests(TestCase):
+    def setUp(self):
+        self.sfr = register_recognizer(SimpleFacerec())
+        self.addCleanup(live_recognizers.discard, self.sfr)
+
+    def test_gallery_follows_person_saves_and_deletes(self):
+        person = Person(name='Sara')
+        person.set_face_encoding(np.zeros(128))
+        person.save()
+        self.assertEqual(self.sfr.known_face_names, [str(person.pk)])
+        generation = self.sfr.generation
+
+        person.set_face_encoding(np.ones(128))
+        person.save()
+        self.assertEqual(self.sfr.generation, generation + 1)
+        self.assertTrue(np.allclose(self.sfr.known_face_encodings[0], 1))
+
+        person.delete()
+        self.assertEqual(self.sfr.known_face_names, [])
+
+    def test_saves_without_a_new_encoding_keep_the_generation(self):
+        person = Person(name='Sara')
+        person.set_face_encoding(np.zeros(128))
+        person.save()
+        generation = self.sfr.generation
+
+        person.about = 'Likes tea'
+        person.save()
+        person = Person.objects.get(pk=person.pk)
+        person.name = 'Sarah'
+        person.save()
+        Person.objects.get(pk=person.pk).save(update_fields=['about'])
+        self.assertEqual(self.sfr.generation, generation)
+
+
+class IVFIndexTests(TestCase):
+    def setUp(self):
+        # 2000 encodings around 40 people-like clusters
+        rng = np.random.default_rng(0)
+        centers = rng.normal(scale=0.3, size=(40, 128))
+        self.encodings = (centers[rng.integers(0, 40, 2000)] + rng.normal(scale=0.05, size=(2000, 128))).astype(np.float32)
+        self.queries = (self.encodings[:300] + rng.normal(scale=0.03, size=(300, 128))).astype(np.float32)
+
+    def test_recall_against_exact_search(self):
+        index = IVFIndex.train(self.encodings, recall=0.95)
+        self.assertLess(index.n_probe, len(index.centroids))
+        sq_norms = np.einsum('ij,ij->i', self.encodings, self.encodings)
+        exact = np.argmin(sq_distances(self.queries, self.encodings, sq_norms), axis=1)
+        best, best_sq, _ = index.search(self.queries, self.encodings, sq_norms)
+        self.assertGreaterEqual(np.mean(best == exact), 0.9)
+        # Distances of the rows found are the exact ones
+        found = best >= 0
+        expected = sq_distances(self.queries, self.encodings, sq_norms)[np.arange(300), best][found]
+        self.assertTrue(np.allclose(best_sq[found], expected, atol=1e-4))
+
+    def test_results_stay_correct_after_remove_face(self):
+        sfr = SimpleFacerec()
+        sfr.ann_recall = 0.95
+        sfr.ann_min_size = 100
+        sfr.set_known_faces(self.encodings, [str(i) for i in range(2000)])
+        self.assertIsNotNone(sfr.snapshot().ann)
+        sfr.remove_face('0')
+        sfr.remove_face('500')
+        gallery = sfr.snapshot()
+        self.assertIsNotNone(gallery.ann)
+        best_index, best_distance, _ = sfr.match_faces(self.encodings[[1, 501, 1999]])
+        self.assertEqual([gallery.names[i] for i in best_index], ['1', '501', '1999'])
+        self.assertTrue(np.all(best_distance < 0.01))
+        # A removed face is never returned
+        best_index, _, _ = sfr.match_faces(self.encodings[[0, 500]])
+        self.assertNotIn('0', [gallery.names[i] for i in best_index])
+        self.assertNotIn('500', [gallery.names[i] for i in best_index])
+
+    @override_settings(FACE_RECOGNITION_ANN_RECALL=0.9, FACE_RECOGNITION_ANN_MIN_SIZE=1)
+    def test_settings_reach_the_recognizer(self):
+        person = Person(name='Sara')
+        person.set_face_encoding(self.encodings[0])
+        person.save()
+        sfr = load_faces_from_db()
+        self.assertEqual((sfr.ann_recall, sfr.ann_min_size), (0.9, 1))
+        self.assertIsNotNone(sfr.snapshot().ann)
+
+
+class FaceTrackerTests(TestCase):
+    def test_identified_faces_are_not_encoded_again_until_reidentify(self):
+        tracker = FaceTracker(reidentify_every=3)
+        track, = tracker.update([(10, 50, 50, 10)], generation=1)
+        self.assertTrue(tracker.needs_identity(track))
+        tracker.identify(track, '7')
+        # The face moved a little: same track, already identified
+        for shift in (2, 4):
+            moved, = tracker.update([(10 + shift, 50 + shift, 50 + shift, 10 + shift)], generation=1)
+            self.assertIs(moved, track)
+            self.assertFalse(tracker.needs_identity(moved))
+        moved, = tracker.update([(16, 56, 56, 16)], generation=1)
+        self.assertTrue(tracker.needs_identity(moved))
+        self.assertEqual((tracker.faces, tracker.encoded), (4, 1))
+
+    def test_new_gallery_generation_identifies_again(self):
+        tracker = FaceTracker()
+        track, = tracker.update([(10, 50, 50, 10)], generation=1)
+        tracker.identify(track, '7')
+        track, = tracker.update([(10, 50, 50, 10)], generation=2)
+        self.assertIsNone(track.name)
+
+    def test_lost_tracks_are_kept_for_max_missed_frames(self):
+        tracker = FaceTracker(max_missed=2)
+        track, = tracker.update([(10, 50, 50, 10)])
+        tracker.identify(track, '7')
+        tracker.update([])
+        tracker.update([])
+        found, = tracker.update([(10, 50, 50, 10)])
+        self.assertIs(found, track)
+        for _ in range(3):
+            tracker.update([])
+        self.assertEqual(tracker.tracks, [])
+
+    def test_faces_far_apart_get_their_own_tracks(self):
+        tracker = FaceTracker()
+        first, second = tracker.update([(10, 50, 50, 10), (10, 150, 50, 110)])
+        self.assertIsNot(first, second)
+        swapped = tracker.update([(10, 150, 50, 110), (10, 50, 50, 10)])
+        self.assertEqual(swapped, [second, first])
+
+
+def jpeg_frame(image):
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+class MotionGateTests(TestCase):
+    def setUp(self):
+        self.still = np.full((480, 640, 3), 100, np.uint8)
+        self.moved = self.still.copy()
+        # Something walks in on the right half
+        self.moved[100:400, 400:600] = 250
+
+    def test_frames_without_motion_are_skipped(self):
+        gate = MotionGate(keyframe_interval=10)
+        self.assertTrue(gate.should_process(jpeg_frame(self.still)))
+        self.assertFalse(gate.should_process(jpeg_frame(self.still)))
+        self.assertTrue(gate.should_process(jpeg_frame(self.moved)))
+        self.assertFalse(gate.should_process(jpeg_frame(self.moved)))
+
+    def test_keyframe_goes_through_without_motion(self):
+        gate = MotionGate(keyframe_interval=3)
+        processed = [gate.should_process(jpeg_frame(self.still)) for _ in range(7)]
+        self.assertEqual(processed, [True, False, False, True, False, False, True])
+
+    def test_motion_outside_the_roi_is_ignored(self):
+        gate = MotionGate(roi=(0, 0, 0.5, 1))
+        gate.should_process(jpeg_frame(self.still))
+        self.assertFalse(gate.should_process(jpeg_frame(self.moved)))
+
+    def test_unreadable_frame_is_not_processed(self):
+        self.assertFalse(MotionGate().should_process(b'not a jpeg'))
+
+
+class DecodeFrameTests(TestCase):
+    def setUp(self):
+        self.image = np.zeros((480, 640, 3), np.uint8)
+        # Blue in BGR
+        self.image[:, :] = (255, 0, 0)
+
+    def test_decoded_at_the_requested_scale_as_rgb(self):
+        jpeg = jpeg_frame(self.image)
+        for scale, shape in ((1.0, (480, 640, 3)), (0.5, (240, 320, 3)), (0.25, (120, 160, 3)), (0.3, (144, 192, 3))):
+            frame = decode_frame(jpeg, scale)
+            self.assertEqual(frame.shape, shape)
+        red, green, blue = decode_frame(jpeg, 0.25)[60, 80]
+        self.assertGreater(blue, 200)
+        self.assertLess(red, 50)
+
+    def test_bgr_is_kept_on_request(self):
+        blue, green, red = decode_frame(jpeg_frame(self.image), 0.5, rgb=False)[10, 10]
+        self.assertGreater(blue, 200)
+
+    def test_unreadable_bytes(self):
+        self.assertIsNone(decode_frame(b'not a jpeg', 0.25))
+
+    def test_crop_roi_is_a_view_with_its_offset(self):
+        frame = np.arange(100 * 200).reshape(100, 200)
+        region, (top, left) = crop_roi(frame, (0.25, 0.5, 0.5, 0.5))
+        self.assertEqual(region.shape, (50, 100))
+        self.assertEqual((top, left), (50, 50))
+        self.assertEqual(region[0, 0], frame[50, 50])
+        self.assertTrue(np.shares_memory(region, frame))
+        # Never empty
+        self.assertEqual(crop_roi(frame, (0.99, 0.99, 0, 0))[0].shape, (1, 1))
+
+
+class PresenceTrackerTests(TestCase):
+    def setUp(self):
+        self.presence = PresenceTracker()
+        self.start = datetime(2024, 1, 1, 8, 0)
+        self.cooldown = timedelta(seconds=60)
+
+    def at(self, seconds):
+        return self.start + timedelta(seconds=seconds)
+
+    def test_standing_in_front_of_a_camera_is_one_event(self):
+        self.assertEqual(self.presence.transitions([1, 2], 'enter', self.at(0), self.cooldown), [1, 2])
+        self.assertEqual(self.presence.transitions([1, 2], 'enter', self.at(1), self.cooldown), [])
+        self.assertEqual(self.presence.transitions([1], 'enter', self.at(30), self.cooldown), [])
+
+    def test_cooldown_counts_from_the_last_sighting(self):
+        self.presence.transitions([1], 'enter', self.at(0), self.cooldown)
+        self.presence.transitions([1], 'enter', self.at(50), self.cooldown)
+        self.assertEqual(self.presence.transitions([1], 'enter', self.at(100), self.cooldown), [])
+        self.assertEqual(self.presence.transitions([1], 'enter', self.at(160), self.cooldown), [1])
+
+    def test_changing_action_is_recorded_right_away(self):
+        self.presence.transitions([1], 'enter', self.at(0), self.cooldown)
+        self.assertEqual(self.presence.transitions([1], 'exit', self.at(5), self.cooldown), [1])
+        self.assertEqual(self.presence.transitions([1], 'enter', self.at(10), self.cooldown), [1])
+
+    def test_load_from_latest_activities(self):
+        self.presence.load([(1, 'enter', self.at(0)), (2, 'exit', None), (3, '', self.at(0))])
+        self.assertEqual(self.presence.transitions([1], 'enter', self.at(10), self.cooldown), [])
+        # Unknown time and persons without an action are recorded
+        self.assertEqual(self.presence.transitions([2, 3], 'exit', self.at(10), self.cooldown), [2, 3])
+
+    def test_load_presence_from_db_uses_the_latest_activity(self):
+        person = Person.objects.create(name='Sara')
+        other = Person.objects.create(name='Omar')
+        now = timezone.now()
+        Activity.objects.create(person=person, action='enter', actual_enter_date=now - timedelta(hours=1))
+        Activity.objects.create(person=person, action='exit', actual_exit_date=now)
+        Activity.objects.create(person=other, action='enter', actual_enter_date=now)
+        presence = load_presence_from_db()
+        self.assertEqual(presence.state, {person.pk: ['exit', now], other.pk: ['enter', now]})
+
+
+class CameraCooldownTests(TestCase):
+    @override_settings(FACE_RECOGNITION_COOLDOWN_SECONDS=60)
+    def test_camera_cooldown_falls_back_to_the_setting(self):
+        self.assertEqual(Camera(name='Door').get_cooldown(), timedelta(seconds=60))
+        self.assertEqual(Camera(name='Hall', cooldown=5).get_cooldown(), timedelta(seconds=5))
+        self.assertEqual(Camera(name='Gate', cooldown=0).get_cooldown(), timedelta(0))
+
+
+class ActivityWriteBehindTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='Room 1')
+        self.person = Person.objects.create(name='Sara', room=self.room)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.journal = os.path.join(directory, 'activity_journal.jsonl')
+
+    def event(self, person_id=None, room_id=None, time='2026-01-01T08:00:00'):
+        return {'person': person_id or self.person.pk, 'room': room_id or self.room.pk, 'action': 'enter',
+                'time': time, 'enter_date': '08:00:00', 'exit_date': None}
+
+    def writer(self, **kwargs):
+        writer = ActivityWriteBehind(self.journal, **kwargs)
+        writer.recover()
+        self.addCleanup(atexit.unregister, writer.close)
+        self.addCleanup(lambda: writer._journal.close())
+        # Batches are flushed by the tests instead of the background task
+        writer._task = object()
+        writer._wakeup = asyncio.Event()
+        return writer
+
+    def journal_events(self):
+        with open(self.journal) as f:
+            return [json.loads(line) for line in f]
+
+    def test_events_are_journaled_and_written_in_batches(self):
+        writer = self.writer(batch_size=3)
+        writer.enqueue([self.event(), self.event()])
+        self.assertEqual(writer.depth, 2)
+        self.assertFalse(writer._wakeup.is_set())
+        self.assertEqual(len(self.journal_events()), 2)
+        self.assertEqual(Activity.objects.count(), 0)
+
+        writer.enqueue([self.event()])
+        self.assertTrue(writer._wakeup.is_set())
+        writer.flush()
+        self.assertEqual(Activity.objects.count(), 3)
+        self.assertEqual((writer.depth, writer.flushed), (0, 3))
+        self.assertEqual(self.journal_events(), [])
+
+    def test_journal_is_replayed_on_recover(self):
+        with open(self.journal, 'w') as f:
+            f.write(json.dumps(self.event()) + '\n')
+            f.write(json.dumps(self.event()) + '\n')
+            # Cut by the crash
+            f.write(json.dumps(self.event())[:20])
+        writer = self.writer()
+        self.assertEqual(Activity.objects.count(), 2)
+        self.assertEqual(writer.depth, 0)
+        self.assertEqual(self.journal_events(), [])
+        writer.enqueue([self.event()])
+        self.assertEqual(self.journal_events(), [self.event()])
+
+    def test_events_of_deleted_persons_and_rooms_do_not_block_the_batch(self):
+        gone = Person.objects.create(name='Omar')
+        gone_room = Room.objects.create(name='Room 2')
+        writer = self.writer()
+        writer.enqueue([self.event(gone.pk), self.event(room_id=gone_room.pk), self.event()])
+        gone.delete()
+        gone_room.delete()
+        writer.flush()
+        self.assertEqual(writer.depth, 0)
+        self.assertCountEqual(
+            Activity.objects.values_list('person_id', 'room_id'),
+            [(self.person.pk, None), (self.person.pk, self.room.pk)],
+        )
+
+    def test_failing_events_go_to_the_dead_letter_file(self):
+        with open(self.journal, 'w') as f:
+            f.write(json.dumps(self.event(time='not a time')) + '\n')
+            f.write(json.dumps(self.event()) + '\n')
+        # Must not raise: recover runs while the consumers module is imported
+        writer = self.writer()
+        self.assertEqual(Activity.objects.count(), 1)
+        self.assertEqual(writer.depth, 0)
+        with open(self.journal + '.failed') as f:
+            failed = [json.loads(line) for line in f]
+        self.assertEqual([entry['event']['time'] for entry in failed], ['not a time'])
+
+
+class AnnotateJpegTests(TestCase):
+    def size(self, jpeg):
+        return cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR).shape[:2]
+
+    def test_full_size_frames_are_halved(self):
+        jpeg = jpeg_frame(np.zeros((480, 640, 3), np.uint8))
+        self.assertEqual(self.size(annotate_jpeg(jpeg, [(100, 300, 300, 100)], ['1'])), (240, 320))
+
+    def test_negotiated_frames_are_relative_to_the_native_resolution(self):
+        # Captured at half the native resolution: already the annotation size
+        jpeg = jpeg_frame(np.zeros((240, 320, 3), np.uint8))
+        self.assertEqual(self.size(annotate_jpeg(jpeg, [(50, 150, 150, 50)], ['1'], capture_scale=0.5)), (240, 320))
+        # Captured at frame_resizing: never upscaled, never shrunk further
+        jpeg = jpeg_frame(np.zeros((120, 160, 3), np.uint8))
+        self.assertEqual(self.size(annotate_jpeg(jpeg, [(25, 75, 75, 25)], ['1'], capture_scale=0.25)), (120, 160))
+
+
+class WorkerGalleryTests(TestCase):
+    def setUp(self):
+        self.gallery_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.gallery_dir)
+        # Worker state is module global, as in a worker process
+        self.enterContext(mock.patch.object(recognition_executor, '_worker_sfr', None))
+        self.known = np.random.default_rng(0).standard_normal((3, 128)).astype(np.float32)
+        self.parent = SimpleFacerec()
+        self.parent.set_known_faces(self.known[:1], ['1'])
+        self.publish()
+        self.parent.add_face('2', self.known[1])
+        self.parent.add_face('3', self.known[2])
+        self.publish()
+
+    def publish(self):
+        gallery = self.parent.snapshot()
+        prefix = os.path.join(self.gallery_dir, str(gallery.generation))
+        np.save(prefix + '.encodings.npy', gallery.encodings)
+        np.save(prefix + '.names.npy', np.array(gallery.names, dtype=str))
+
+    def worker(self, *generations):
+        recognition_executor._init_worker({})
+        for generation in generations:
+            recognition_executor._load_gallery(self.gallery_dir, generation)
+        return recognition_executor._worker_sfr
+
+    def detect(self, worker, generation, tracker):
+        recognition_executor._worker_sfr = worker
+        face_locations, face_names, tracker = recognition_executor._detect(
+            np.zeros((240, 320, 3), np.uint8), self.gallery_dir, generation, tracker)
+        return face_names, tracker
+
+    def test_workers_report_the_published_generation(self):
+        # Worker a followed every change, worker b only loaded the latest one
+        a = self.worker(1, 3)
+        b = self.worker(3)
+        c = self.worker(1)
+        self.assertEqual((a.generation, b.generation, c.generation), (3, 3, 1))
+
+    def test_tracks_are_kept_across_workers_and_reset_on_a_new_gallery(self):
+        a, b, stale = self.worker(1, 3), self.worker(3), self.worker(1)
+        with mock.patch('face_recognition.face_locations', return_value=[(10, 50, 50, 10)]), \
+                mock.patch('face_recognition.face_encodings', return_value=[self.known[0]]):
+            names, tracker = self.detect(a, 3, FaceTracker())
+            self.assertEqual(names, ['1'])
+            # The next frame of the camera lands on another worker holding the same gallery
+            names, tracker = self.detect(b, 3, tracker)
+            self.assertEqual(names, ['1'])
+            self.assertEqual((tracker.faces, tracker.encoded), (2, 1))
+            # A worker that only ever loaded an older gallery identifies again
+            names, tracker = self.detect(stale, 1, tracker)
+            self.assertEqual((tracker.faces, tracker.encoded), (3, 2))
+
+
+class ExecutorGenerationFilesTests(TestCase):
+    def setUp(self):
+        self.sfr = SimpleFacerec()
+        self.sfr.set_known_faces(np.zeros((1, 128), np.float32), ['1'])
+        self.executor = recognition_executor.RecognitionExecutor(self.sfr, max_workers=1)
+        self.addCleanup(self.executor.shutdown)
+        # Threads instead of worker processes, running the patched _detect
+        self.executor._pool.shutdown()
+        self.executor._pool = ThreadPoolExecutor(2)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.found = []
+
+    def fake_detect(self, frame, gallery_dir, generation, tracker, roi=None, scale=None):
+        if frame == b'slow':
+            self.started.set()
+            self.release.wait(5)
+        self.found.append(os.path.isfile(os.path.join(gallery_dir, f'{generation}.encodings.npy')))
+        return [], [], tracker
+
+    def published(self):
+        return sorted(int(name.split('.')[0]) for name in os.listdir(self.executor._gallery_dir))
+
+    def test_generation_of_a_queued_frame_stays_on_disk(self):
+        async def run():
+            slow = asyncio.create_task(self.executor.detect_known_faces(b'slow'))
+            await asyncio.get_running_loop().run_in_executor(None, self.started.wait, 5)
+            for name in ('2', '3', '4'):
+                self.sfr.add_face(name, np.ones(128, np.float32))
+                await self.executor.detect_known_faces(b'fast')
+            # Past KEEP_GENERATIONS, but the slow frame still points to the first one
+            self.assertEqual(self.published(), [1, 1, 3, 3, 4, 4])
+            self.release.set()
+            await slow
+
+        with mock.patch.object(recognition_executor, '_detect', self.fake_detect):
+            asyncio.run(run())
+        self.assertEqual(self.found, [True] * 4)
+        self.assertEqual(self.published(), [3, 3, 4, 4])
+
+
+class FakeRecognizer:
+    """
+    A camera's share of the recognition workers that finds no face, frames wait until release is set
+    """
+
+    def __init__(self, released=True):
+        self.frames = []
+        self.times = []
+        self.last_wait = 0.0
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        if released:
+            self.release.set()
+
+    async def detect_known_faces(self, frame, tracker=None, roi=None, scale=None):
+        self.frames.append(frame)
+        self.times.append(asyncio.get_running_loop().time())
+        self.started.set()
+        await self.release.wait()
+        return [], []
+
+
+class CameraConsumerTestCase(TestCase):
+    """
+    Drives CameraVideoStreamConsumer through the websocket routes, recognition is a FakeRecognizer
+    """
+
+    def setUp(self):
+        # Imported here, the consumers module loads the gallery from the test database
+        from . import consumers
+        from .routing import websocket_urlpatterns
+
+        self.application = URLRouter(websocket_urlpatterns)
+        self.camera = Camera.objects.create(name='Door', direction='enter', frame_budget=0)
+        self.recognizer = FakeRecognizer()
+        self.new_recognizer = self.enterContext(
+            mock.patch.object(consumers.scheduler, 'camera', side_effect=lambda *args: self.recognizer))
+        # Every frame goes through recognition
+        self.enterContext(mock.patch.object(consumers.MotionGate, 'should_process', return_value=True))
+        self.frames = [jpeg_frame(np.full((120, 160, 3), value, np.uint8)) for value in (0, 60, 120, 180)]
+
+    async def connect(self, path=None):
+        communicator = WebsocketCommunicator(self.application, path or f'/ws/camera/{self.camera.pk}/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+
+@override_settings(FACE_RECOGNITION_CAPTURE_CREDITS=4)
+class LatestFrameWinsTests(CameraConsumerTestCase):
+    def test_only_the_newest_pending_frame_is_processed(self):
+        self.recognizer = FakeRecognizer(released=False)
+
+        async def run():
+            communicator = await self.connect()
+            await communicator.receive_json_from()
+            await communicator.send_to(bytes_data=self.frames[0])
+            await asyncio.wait_for(self.recognizer.started.wait(), 5)
+            for frame in self.frames[1:]:
+                await communicator.send_to(bytes_data=frame)
+            # The second and third frames were replaced before being picked up, their credits come back
+            for _ in range(2):
+                self.assertEqual(await communicator.receive_json_from(), {'type': 'flow', 'credits': 1, 'interval': 0})
+            self.recognizer.release.set()
+            replies = [await communicator.receive_json_from() for _ in range(2)]
+            await communicator.disconnect()
+            return replies
+
+        replies = async_to_sync(run)()
+        self.assertEqual(self.recognizer.frames, [self.frames[0], self.frames[3]])
+        stats = replies[-1]['stats']
+        self.assertEqual((stats['received'], stats['processed'], stats['dropped']), (4, 2, 2))
+
+    def test_frames_are_picked_up_within_the_frame_budget(self):
+        self.camera.frame_budget = 20
+        self.camera.save()
+
+        async def run():
+            communicator = await self.connect()
+            flow = await communicator.receive_json_from()
+            for frame in self.frames[:2]:
+                await communicator.send_to(bytes_data=frame)
+                await communicator.receive_json_from()
+            await communicator.disconnect()
+            return flow
+
+        flow = async_to_sync(run)()
+        self.assertEqual(flow['interval'], 50)
+        first, second = self.recognizer.times
+        self.assertGreaterEqual(second - first, 0.049)
+
+
+class CaptureCreditTests(CameraConsumerTestCase):
+    @override_settings(FACE_RECOGNITION_CAPTURE_CREDITS=2)
+    def test_credits_are_granted_on_connect_and_returned_with_each_reply(self):
+        async def run():
+            communicator = await self.connect()
+            flow = await communicator.receive_json_from()
+            replies = []
+            for frame in self.frames[:3]:
+                await communicator.send_to(bytes_data=frame)
+                replies.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return flow, replies
+
+        flow, replies = async_to_sync(run)()
+        self.assertEqual(flow, {'type': 'flow', 'credits': 2, 'interval': 0})
+        self.assertEqual([reply['credits'] for reply in replies], [1, 1, 1])
+        self.assertEqual(replies[-1]['stats']['processed'], 3)
+
+    @override_settings(FACE_RECOGNITION_CAPTURE_CREDITS=1)
+    def test_frames_sent_without_a_credit_are_dropped(self):
+        self.recognizer = FakeRecognizer(released=False)
+
+        async def run():
+            communicator = await self.connect()
+            await communicator.receive_json_from()
+            await communicator.send_to(bytes_data=self.frames[0])
+            await asyncio.wait_for(self.recognizer.started.wait(), 5)
+            # The only credit is in use: dropped, and no credit comes back for it
+            await communicator.send_to(bytes_data=self.frames[1])
+            self.assertTrue(await communicator.receive_nothing(0.1))
+            self.recognizer.release.set()
+            reply = await communicator.receive_json_from()
+            # The answered frame returned its credit, the next one goes through
+            await communicator.send_to(bytes_data=self.frames[2])
+            last = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return reply, last
+
+        reply, last = async_to_sync(run)()
+        self.assertEqual(reply['credits'], 1)
+        self.assertEqual(self.recognizer.frames, [self.frames[0], self.frames[2]])
+        stats = last['stats']
+        self.assertEqual((stats['received'], stats['processed'], stats['dropped']), (3, 2, 1))
+
+
+class AnnotatedFrameTests(CameraConsumerTestCase):
+    def test_subscribers_share_one_encoded_frame(self):
+        from .ai_models import recognize
+
+        async def run():
+            capture = await self.connect()
+            viewers = [await self.connect() for _ in range(2)]
+            for communicator in [capture] + viewers:
+                await communicator.receive_json_from()
+            for viewer in viewers:
+                await viewer.send_json_to({'subscribe': 'annotated'})
+            # Let the subscriptions land before the frame
+            await viewers[-1].receive_nothing(0.05)
+            await capture.send_to(bytes_data=self.frames[0])
+            await capture.receive_json_from()
+            received = [await viewer.receive_from() for viewer in viewers]
+            # The capture client did not subscribe
+            self.assertTrue(await capture.receive_nothing(0.05))
+            for communicator in [capture] + viewers:
+                await communicator.disconnect()
+            return received
+
+        with mock.patch.object(recognize, 'annotate_jpeg', wraps=recognize.annotate_jpeg) as annotate:
+            received = async_to_sync(run)()
+        self.assertEqual(annotate.call_count, 1)
+        self.assertIsInstance(received[0], bytes)
+        self.assertTrue(received[0].startswith(b'\xff\xd8'))
+        self.assertEqual(received[0], received[1])
+
+    def test_frames_are_not_drawn_without_subscribers(self):
+        from .ai_models import recognize
+
+        async def run():
+            capture = await self.connect()
+            await capture.receive_json_from()
+            await capture.send_to(bytes_data=self.frames[0])
+            await capture.receive_json_from()
+            await capture.disconnect()
+
+        with mock.patch.object(recognize, 'annotate_jpeg') as annotate:
+            async_to_sync(run)()
+        annotate.assert_not_called()
+
+
+class CameraRoutingTests(CameraConsumerTestCase):
+    def connected_camera(self, path):
+        async def run():
+            communicator = WebsocketCommunicator(self.application, path)
+            connected, _ = await communicator.connect()
+            if connected:
+                await communicator.disconnect()
+            return connected
+
+        self.new_recognizer.reset_mock()
+        if not async_to_sync(run)():
+            return None
+        (camera_id, weight), = [call.args for call in self.new_recognizer.call_args_list]
+        return Camera.objects.get(pk=camera_id)
+
+    def test_legacy_endpoints_reach_the_first_enter_and_exit_cameras(self):
+        # The Enter and Exit cameras created by the migration come before the ones added later
+        Camera.objects.create(name='Back door', direction='exit')
+        enter = Camera.objects.filter(direction='enter').order_by('pk').first()
+        exit_camera = Camera.objects.filter(direction='exit').order_by('pk').first()
+        self.assertEqual(self.connected_camera('/ws/video/'), enter)
+        self.assertEqual(self.connected_camera('/ws/exit/'), exit_camera)
+        self.assertEqual((enter.name, exit_camera.name), ('Enter', 'Exit'))
+
+    def test_camera_endpoint_by_id(self):
+        self.assertEqual(self.connected_camera(f'/ws/camera/{self.camera.pk}/'), self.camera)
+
+    def test_unknown_camera_is_rejected(self):
+        self.assertIsNone(self.connected_camera('/ws/camera/999999/'))
+        self.new_recognizer.assert_not_called()
@@ -12,5 +12,6 @@ urlpatterns=[
     path('rooms/', views.get_all_rooms, name='all-rooms'),
     path('room/<int:id>/update/', views.update_room, name='update-room'),
     path('room/<int:id>/', views.get_room_by_id, name='get-room'),
+    path('cameras/', views.get_all_cameras, name='all-cameras'),
     
 ]
\ No newline at end of file
@@ -3,7 +3,7 @@ from .models import  Person,Activity
 from .models import Person
 from django.shortcuts import render
 from django.utils import timezone
-from .models import Person, Activity, Room
+from .models import Person, Activity, Room, Camera
 # rest framework
 
 from rest_framework import permissions ,status
@@ -16,12 +16,19 @@ from django.utils import timezone
 import os
 import cv2
 import numpy as np
-import pandas as pd
-from django.http import HttpResponse
+import csv
+import itertools
+import tempfile
+from openpyxl import Workbook
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse
+from django.db.models import Prefetch, Q
 from datetime import datetime
 
 from facerecognition.ai_models.recognize import encode_faces,detect_,encode_face
-from .serializers import  PersonSerializer,ActivitySerializer,RoomSerializer
+from .serializers import  PersonSerializer,RoomSerializer,CameraSerializer
+from .camera_stats import camera_throughput
+from .serializers import activity_values, serialize_activity_values
+from .room_cache import ALL_ROOMS, cached_payload, room_key
 from rest_framework import permissions, status
 # get_object_or_404
 from django.shortcuts import get_object_or_404
@@ -37,49 +44,92 @@ def _face_recognition(request):
     return render(request,'face_recognition.html')
 
 def all_acrivites_page(request):
-    activities = Activity.objects.all()
-    serializer = ActivitySerializer(activities, many=True)
+    activities = serialize_activity_values(activity_values(Activity.objects.all()))
     
-    return render(request,'all_activities.html',{'person_activities':serializer.data})
+    return render(request,'all_activities.html',{'person_activities':activities})
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_COLUMNS = ['Name', 'About', 'Enter Date', 'Exit Date', 'Actual Enter Date', 'Actual Exit Date', 'Action', 'Image']
+
+def export_rows(activities):
+    """
+    this function yields the export rows one by one, the activities are fetched from the database
+    in chunks of EXPORT_CHUNK_SIZE rows so only one chunk is held in memory at a time
+    """
+    rows = activities.values_list(
+        'person__name', 'person__about', 'enter_date', 'exit_date', 'actual_enter_date', 'actual_exit_date',
+        'action', 'image',
+    ).order_by('date', 'id')
+    image_url = Activity._meta.get_field('image').storage.url
+    for name, about, enter_date, exit_date, actual_enter_date, actual_exit_date, action, image in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield [
+            name,
+            about,
+            enter_date.strftime('%Y-%m-%d %I:%M %p') if enter_date else '',
+            exit_date.strftime('%Y-%m-%d %I:%M %p') if exit_date else '',
+            actual_enter_date.strftime('%Y-%m-%d %I:%M %p') if actual_enter_date else '',
+            actual_exit_date.strftime('%Y-%m-%d %I:%M %p') if actual_exit_date else '',
+            action,
+            image_url(image) if image else 'No Image',
+        ]
+
+class Echo:
+    # csv.writer target that hands every written line back instead of buffering it
+    def write(self, value):
+        return value
 
 def export_activities_to_excel(request):
-    # Query all activities and related data
-    activities = Activity.objects.select_related('person').all()
-
-    # Create a DataFrame from the activities data
-    data = []
-    for activity in activities:
-        data.append({
-            'Name': activity.person.name,
-            'About': activity.person.about,
-            'Enter Date': activity.enter_date.strftime('%Y-%m-%d %I:%M %p') if activity.enter_date else '',
-            'Exit Date': activity.exit_date.strftime('%Y-%m-%d %I:%M %p') if activity.exit_date else '',
-            'Actual Enter Date': activity.actual_enter_date.strftime('%Y-%m-%d %I:%M %p') if activity.actual_enter_date else '',
-            'Actual Exit Date': activity.actual_exit_date.strftime('%Y-%m-%d %I:%M %p') if activity.actual_exit_date else '',
-            'Action': activity.action,
-            'Image': activity.image.url if activity.image else 'No Image'
-        })
-
-    # Create pandas DataFrame
-    df = pd.DataFrame(data)
-
-    # Create a response with the Excel file as the content
-    response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    response['Content-Disposition'] = 'attachment; filename="activities.xlsx"'
-
-    # Write the DataFrame to an Excel file
-    with pd.ExcelWriter(response, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Activities')
-
-    return response
+    """
+    this function exports the activities, optionally filtered like the activity list
+    (date_from, date_to, person, room, action).
+    ?format=csv streams the rows as they are read, the default xlsx is built with a
+    write-only workbook in a temporary file, both in constant memory.
+    """
+    try:
+        activities = filter_activities(Activity.objects.all(), request.GET)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+
+    if request.GET.get('format') == 'csv':
+        writer = csv.writer(Echo())
+        lines = (writer.writerow(row) for row in itertools.chain([EXPORT_COLUMNS], export_rows(activities)))
+        response = StreamingHttpResponse(lines, content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="activities.csv"'
+        return response
+
+    # Write-only worksheets are serialized row by row to disk, the zip is assembled on save
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Activities')
+    sheet.append(EXPORT_COLUMNS)
+    for row in export_rows(activities):
+        sheet.append(row)
+    file = tempfile.TemporaryFile()
+    workbook.save(file)
+    file.seek(0)
+    return FileResponse(
+        file, as_attachment=True, filename='activities.xlsx',
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    )
+
+def room_queryset():
+    # Owners in one query, without their face encodings
+    return Room.objects.prefetch_related(Prefetch('owner', queryset=Person.objects.defer('face_encoding')))
+
+def cached_room_response(request, key, build):
+    """
+    this function answers from the room cache: 304 without building anything when the
+    client already has the current payload (If-None-Match), else the cached payload
+    """
+    etag, data = cached_payload(key, build)
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(data, headers={'ETag': etag})
 
 # get all rooms
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_all_rooms(request):
-    rooms = Room.objects.all()
-    serializer = RoomSerializer(rooms, many=True)
-    return Response(serializer.data)
+    return cached_room_response(request, ALL_ROOMS, lambda: RoomSerializer(room_queryset(), many=True).data)
 # update_room
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -95,13 +145,20 @@ def update_room(request, id):
         return Response({'details': 'Room updated successfully'}, status=status.HTTP_200_OK)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+# get all cameras, with the throughput of the ones streaming to this process
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_all_cameras(request):
+    cameras = CameraSerializer(Camera.objects.all(), many=True).data
+    for camera in cameras:
+        throughput = camera_throughput.get(camera['id'])
+        camera['throughput'] = throughput.as_dict() if throughput else None
+    return Response(cameras)
 # get room by id
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_room_by_id(request, id):
-    room = get_object_or_404(Room, id=id)
-    serializer = RoomSerializer(room)
-    return Response(serializer.data)
+    return cached_room_response(request, room_key(id), lambda: RoomSerializer(get_object_or_404(room_queryset(), id=id)).data)
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def add_person(request):
@@ -135,7 +192,7 @@ def add_person(request):
     person.save()
     encoding = encode_face(person.image.path)
     if encoding is not None:
-        person.face_encoding = str(encoding.tolist())
+        person.set_face_encoding(encoding)
         person.save()
     else:
         person.delete()
@@ -175,7 +232,7 @@ def update_person(request, id):  # `id` is now explicitly passed as a URL parame
         if img:
             encoding = encode_face(person.image.path)
             if encoding is not None:
-                person.face_encoding = str(encoding.tolist())
+                person.set_face_encoding(encoding)
                 person.save()
             else:
                 # Delete the person if no face detected
@@ -189,9 +246,60 @@ def update_person(request, id):  # `id` is now explicitly passed as a URL parame
     
     
 # get all Activity
+ACTIVITY_PAGE_SIZE = 50
+ACTIVITY_MAX_PAGE_SIZE = 500
+
+def encode_activity_cursor(row):
+    return base64.urlsafe_b64encode(f"{row['date'].isoformat()}:{row['id']}".encode()).decode()
+
+def decode_activity_cursor(cursor):
+    date, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+    return datetime.strptime(date, '%Y-%m-%d').date(), int(pk)
+
+def filter_activities(activities, params):
+    """
+    this function applies the person, room, action, date_from and date_to (YYYY-MM-DD) filters
+    :raise ValueError: on a malformed filter
+    """
+    if params.get('person'):
+        activities = activities.filter(person_id=int(params['person']))
+    if params.get('room'):
+        activities = activities.filter(room_id=int(params['room']))
+    if params.get('action'):
+        activities = activities.filter(action=params['action'])
+    if params.get('date_from'):
+        activities = activities.filter(date__gte=datetime.strptime(params['date_from'], '%Y-%m-%d').date())
+    if params.get('date_to'):
+        activities = activities.filter(date__lte=datetime.strptime(params['date_to'], '%Y-%m-%d').date())
+    return activities
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_all_activity(request):
-    activities = Activity.objects.all()
-    serializer = ActivitySerializer(activities, many=True)
-    return Response(serializer.data)
\ No newline at end of file
+    """
+    this function returns one page of activities, newest first, as {'results': [...], 'next': url}.
+    Pages are keyset paginated on (date, id): the cursor is the last row of the previous page, so
+    every page is one index range scan whatever the size of the table.
+    """
+    try:
+        activities = filter_activities(Activity.objects.all(), request.query_params)
+        page_size = min(int(request.query_params.get('page_size', ACTIVITY_PAGE_SIZE)), ACTIVITY_MAX_PAGE_SIZE)
+        if page_size < 1:
+            raise ValueError('page_size must be positive')
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            date, pk = decode_activity_cursor(cursor)
+            activities = activities.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    # One extra row tells if there is a next page
+    # The person is joined in the same query, only the serialized columns are read
+    page = list(activity_values(activities.order_by('-date', '-id'))[:page_size + 1])
+    next_url = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        params = request.query_params.copy()
+        params['cursor'] = encode_activity_cursor(page[-1])
+        next_url = request.build_absolute_uri(f'{request.path}?{params.urlencode()}')
+    return Response({'results': serialize_activity_values(page), 'next': next_url})
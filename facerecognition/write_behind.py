@@ -0,0 +1,219 @@
+import asyncio
+import atexit
+import json
+import os
+import threading
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.db import InterfaceError, OperationalError, transaction
+
+# The database is unreachable or busy: the whole batch is retried later
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+def write_activities(events):
+    """
+    Write a batch of recorded enter/exit events: one bulk insert of the
+    activities, the in_house flag of the persons whose presence changes and
+    the occupancy counts, lights are only switched when a room or the house
+    goes from empty to occupied or back.
+    Events of persons deleted since they were recorded are dropped and rooms
+    deleted meanwhile are left empty, so one stale event cannot fail the batch.
+    """
+    from .models import Activity, Person, Room, apply_occupancy_changes
+    from .room_cache import invalidate_rooms
+
+    if not events:
+        return
+
+    with transaction.atomic():
+        before = {
+            person_id: (in_house, room_id)
+            for person_id, in_house, room_id in Person.objects.filter(
+                pk__in={event['person'] for event in events}
+            ).values_list('pk', 'in_house', 'room_id')
+        }
+        # The rooms of the events are normally the current rooms of their persons,
+        # only the others are looked up
+        rooms = {room_id for in_house, room_id in before.values()}
+        unknown = {event['room'] for event in events if event['room'] is not None} - rooms
+        if unknown:
+            rooms.update(Room.objects.filter(pk__in=unknown).values_list('pk', flat=True))
+        activities = []
+        for event in events:
+            if event['person'] not in before:
+                continue
+            when = datetime.fromisoformat(event['time'])
+            entering = event['action'] == 'enter'
+            activities.append(Activity(
+                person_id=event['person'],
+                room_id=event['room'] if event['room'] in rooms else None,
+                date=when,
+                enter_date=event['enter_date'],
+                exit_date=event['exit_date'],
+                action=event['action'],
+                actual_enter_date=when if entering else None,
+                actual_exit_date=None if entering else when,
+            ))
+        if len(activities) < len(events):
+            print(f"{len(events) - len(activities)} activities of deleted persons dropped")
+        Activity.objects.bulk_create(activities)
+        # Last action of each person in the batch wins
+        in_house = {event['person']: event['action'] == 'enter' for event in events if event['person'] in before}
+        changes = []
+        for state in (True, False):
+            person_ids = [p for p, inside in in_house.items() if inside == state and before[p][0] != state]
+            if person_ids:
+                Person.objects.filter(pk__in=person_ids).update(in_house=state)
+                changes.extend((before[p], (state, before[p][1])) for p in person_ids)
+        apply_occupancy_changes(changes, lights=True)
+        # in_house is part of the owners listed with the rooms
+        if changes:
+            invalidate_rooms(room_id for (in_house, room_id), new in changes)
+
+
+class ActivityWriteBehind:
+    """
+    Buffers enter/exit events off the recognition path and writes them in
+    batches, when batch_size events are pending or every interval seconds.
+
+    Every event is appended to a journal file before it is acknowledged, so
+    pending writes survive a crash of the process: the journal is replayed on
+    the next start. Replay is at-least-once, a crash between a commit and the
+    journal rewrite can record the last batch twice.
+
+    A batch failing for any other reason is written again one event at a
+    time, the events that still fail are moved to a dead letter file next to
+    the journal (<journal>.failed) instead of holding back the ones after them.
+    """
+
+    def __init__(self, journal_path, batch_size=50, interval=2.0):
+        self.journal_path = str(journal_path)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pending = []
+        self.flushed = 0
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._task = None
+        self._journal = None
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def recover(self):
+        """
+        Write the events left in the journal by a previous process.
+        Runs at startup, so it never raises: events that cannot be written yet stay pending.
+        """
+        events = []
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # Last line cut by the crash: keep the complete ones
+                        break
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.pending = events + self.pending
+            # Rewritten from the parsed events, a line cut by the crash would corrupt the next one appended
+            self._journal = open(self.journal_path, 'a')
+            self._rewrite_journal()
+        atexit.register(self.close)
+        if events:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Could not write the {len(events)} activities recovered from {self.journal_path},"
+                      " they stay pending:", e)
+            else:
+                print(f"{len(events)} pending activities recovered from {self.journal_path}")
+
+    def enqueue(self, events):
+        """
+        Buffer events, each one a dict with person, room, action, time (isoformat),
+        enter_date and exit_date (HH:MM:SS strings or None)
+        """
+        if not events:
+            return
+        with self._lock:
+            for event in events:
+                self._journal.write(json.dumps(event) + '\n')
+            # Reaches the OS, which keeps it if the process dies, without paying for an fsync
+            self._journal.flush()
+            self.pending.extend(events)
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await sync_to_async(self.flush)()
+            except Exception as e:
+                print("Error writing activities:", e)
+
+    def flush(self):
+        with self._lock:
+            batch = self.pending
+            self.pending = []
+        if not batch:
+            return
+        try:
+            write_activities(batch)
+        except TRANSIENT_ERRORS:
+            with self._lock:
+                self.pending = batch + self.pending
+            raise
+        except Exception as e:
+            print("Error writing activities, writing them one by one:", e)
+            self._write_each(batch)
+        with self._lock:
+            self.flushed += len(batch)
+            self._rewrite_journal()
+
+    def _write_each(self, batch):
+        for i, event in enumerate(batch):
+            try:
+                write_activities([event])
+            except TRANSIENT_ERRORS:
+                with self._lock:
+                    self.pending = batch[i:] + self.pending
+                raise
+            except Exception as e:
+                self._dead_letter(event, e)
+
+    def _dead_letter(self, event, error):
+        print(f"Activity moved to {self.journal_path}.failed:", error)
+        with open(self.journal_path + '.failed', 'a') as f:
+            f.write(json.dumps({'event': event, 'error': repr(error)}) + '\n')
+
+    def _rewrite_journal(self):
+        # Only the events still pending stay in the journal
+        self._journal.close()
+        with open(self.journal_path + '.tmp', 'w') as f:
+            for event in self.pending:
+                f.write(json.dumps(event) + '\n')
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+
+    def close(self):
+        """
+        Flush what is pending, called on graceful shutdown
+        """
+        try:
+            self.flush()
+        except Exception as e:
+            print("Error writing activities on shutdown, kept in the journal:", e)